@@ -14,6 +14,8 @@ if __name__ == '__main__':
     Example usage:
         > python main.py pomcp --env Tiger-2D.POMDP
         > python main.py pbvi --env Tiger-2D.POMDP
+        > python main.py pbvi --env GridWorld.POMDP --policy policies/GridWorld  (solves once, reloads afterwards)
+        > python main.py pomcp --env RockSample-11x11  (generated procedurally, no environment file)
     """
     parser = argparse.ArgumentParser(description='Solve pomdp')
     parser.add_argument('config', type=str, help='The file name of algorithm configuration (without JSON extension)')
@@ -24,6 +26,10 @@ if __name__ == '__main__':
     parser.add_argument('--random_prior', type=bool, default=False,
                         help='Whether or not to use a randomly generated distribution as prior belief, default to False')
     parser.add_argument('--max_play', type=int, default=100, help='Maximum number of play steps')
+    parser.add_argument('--sparse', type=bool, default=False,
+                        help='Whether to store the transition and observation tables as sparse matrices and track beliefs by their support, default to False')
+    parser.add_argument('--policy', type=str, default=None,
+                        help='Folder of the PBVI policy: loaded instead of solving when it was saved for the same model, otherwise saved there after solving')
 
     args = vars(parser.parse_args())
     params = RunnerParams(**args)
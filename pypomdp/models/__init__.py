@@ -1,3 +1,4 @@
 
 from .model import Model
-from .rock_sample_problem import RockSampleModel
\ No newline at end of file
+from .rock_sample_problem import RockSampleModel
+from .factored_model import FactoredModel
@@ -0,0 +1,431 @@
+import numpy as np
+
+from util.csr_matrix import CSRMatrix
+
+WILDCARD = '*'
+
+
+def index_of(name_index, name):
+    """
+    Resolves a name from a POMDP table key into an integer index, or a full slice for the '*' wildcard
+    """
+    if name == WILDCARD:
+        return slice(None)
+    return name_index[name]
+
+
+class DenseDynamics(object):
+    """
+    Integer-indexed tensor representation of a POMDP's dynamics:
+        T[a, s, s']       transition probabilities
+        Z[a, s', o]       observation probabilities
+        R[a, s]           expected immediate reward of taking a in s
+        R_full[a, s, s', o]  full reward tensor; only kept when the rewards actually depend on s' or o
+    """
+    def __init__(self, T, Z, R, R_full=None):
+        self.T = T
+        self.Z = Z
+        self.R = R
+        self.R_full = R_full
+        self.all_states = np.arange(T.shape[1])
+        self.all_observations = np.arange(Z.shape[2])
+
+    @staticmethod
+    def from_tables(states, actions, observations, T, Z, R):
+        """
+        Compiles dictionaries keyed by tuples of names into tensors.
+        Later table entries override earlier ones, so wildcard defaults can be refined by specific entries.
+        """
+        return compile_tables(DenseBuilder(len(states), len(actions), len(observations)),
+                              states, actions, observations, T, Z, R)
+
+    def to_arrays(self):
+        """
+        :return: the tensors as a dictionary of plain arrays, e.g. to be stored with numpy.savez
+        """
+        arrays = {'T': self.T, 'Z': self.Z, 'R': self.R}
+        if self.R_full is not None:
+            arrays['R_full'] = self.R_full
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        return DenseDynamics(arrays['T'], arrays['Z'], arrays['R'], arrays.get('R_full'))
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self.T, self.Z, self.R, self.R_full) if arr is not None)
+
+    def dense_tables(self, a):
+        """
+        :return: T[a] and Z[a] as dense matrices
+        """
+        return self.T[a], self.Z[a]
+
+    def transition(self, a, si, sj):
+        return self.T[a, si, sj]
+
+    def observation(self, a, sj, o):
+        return self.Z[a, sj, o]
+
+    def reward(self, a, si, sj=None, o=None):
+        if sj is None or o is None or self.R_full is None:
+            return self.R[a, si]
+        return self.R_full[a, si, sj, o]
+
+    def transition_probs(self, a, si):
+        """
+        :return: (next states, probabilities) when taking action a at state si
+        """
+        return self.all_states, self.T[a, si]
+
+    def observation_probs(self, a, sj):
+        """
+        :return: (observations, probabilities) when landing in state sj after action a
+        """
+        return self.all_observations, self.Z[a, sj]
+
+    def transition_rows(self):
+        """
+        :return: CSRMatrix of shape (|A| * |S|) x |S|, row a * |S| + s is the distribution T(a, s, .)
+        """
+        n_a, n_s, _ = self.T.shape
+        return CSRMatrix.from_dense(self.T.reshape(n_a * n_s, n_s))
+
+    def observation_rows(self):
+        """
+        :return: CSRMatrix of shape (|A| * |S|) x |O|, row a * |S| + s' is the distribution Z(a, s', .)
+        """
+        n_a, n_s, n_o = self.Z.shape
+        return CSRMatrix.from_dense(self.Z.reshape(n_a * n_s, n_o))
+
+    def observation_likelihood(self, a, o):
+        """
+        :return: Z(a, s', o) for every next state s'
+        """
+        return self.Z[a, :, o]
+
+    def observation_likelihoods(self, a, observations):
+        """
+        :return: |observations| x |S| matrix, row i holds Z(a, s', observations[i]) for every next state s'
+        """
+        return self.Z[a][:, observations].T
+
+    def backproject(self, a, o, vectors):
+        """
+        Projects value vectors one step back through action a and observation o:
+            out[k, s] = sum_{s'} T(a, s, s') * Z(a, s', o) * vectors[k, s']
+        :param vectors: |K| x |S| matrix
+        :return: |K| x |S| matrix
+        """
+        return (vectors * self.observation_likelihood(a, o)).dot(self.T[a].T)
+
+    def backproject_all(self, a, vectors):
+        """
+        backproject for every observation at once
+        :param vectors: |K| x |S| matrix
+        :return: |O| x |K| x |S| tensor
+        """
+        weighted = vectors[None, :, :] * self.Z[a].T[:, None, :]
+        return weighted.dot(self.T[a].T)
+
+    def propagate(self, a, belief):
+        """
+        :return: predicted state distribution b'(s') = sum_s b(s) * T(a, s, s')
+        """
+        return np.dot(belief, self.T[a])
+
+    def propagate_sparse(self, a, states, probs):
+        """
+        propagate for a belief given by its support
+        :return: (next states, probabilities) of the predicted distribution's support
+        """
+        predicted = np.dot(probs, self.T[a, states])
+        next_states = np.flatnonzero(predicted)
+        return next_states, predicted[next_states]
+
+    def observation_probabilities(self, a, states, o):
+        """
+        :return: Z(a, s', o) for the given next states s'
+        """
+        return self.Z[a, states, o]
+
+
+class SparseDynamics(object):
+    """
+    Same interface as DenseDynamics, but T and Z are stored as one CSR matrix per action:
+        T[a]  |S| x |S'| matrix, row s holds the successor states of s and their probabilities
+        Z[a]  |S'| x |O| matrix, row s' holds the possible observations in s' and their probabilities
+    Memory scales with the number of non-zero entries rather than quadratically with |S|.
+    """
+    def __init__(self, T, Z, R, R_specific=None):
+        self.T = T
+        self.Z = Z
+        self.R = R
+        self.R_specific = R_specific or {}
+
+    @staticmethod
+    def from_tables(states, actions, observations, T, Z, R):
+        """
+        Compiles dictionaries keyed by tuples of names without ever materialising a dense |S| x |S| table
+        """
+        return compile_tables(SparseBuilder(len(states), len(actions), len(observations)),
+                              states, actions, observations, T, Z, R)
+
+    def to_arrays(self):
+        """
+        :return: the dynamics as a dictionary of plain arrays, e.g. to be stored with numpy.savez.
+        The per-action matrices are stacked into one CSR matrix per table, and R_specific is flattened into
+        (a, s, s', o, value) rows, -1 standing for the entries' wildcards
+        """
+        arrays = {'R': self.R}
+        for name, matrices in (('T', self.T), ('Z', self.Z)):
+            stacked = CSRMatrix.vstack(matrices)
+            arrays[name + '_indptr'], arrays[name + '_indices'], arrays[name + '_data'] = \
+                stacked.indptr, stacked.indices, stacked.data
+            arrays[name + '_shape'] = np.array(matrices[0].shape, dtype=np.int64)
+
+        specific = [(a, s, -1 if sj is None else sj, -1 if o is None else o, value)
+                    for (a, s), entries in self.R_specific.items() for sj, o, value in entries]
+        arrays['R_specific'] = np.array(specific, dtype=np.float64).reshape(-1, 5)
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        """
+        Inverse of to_arrays, the per-action matrices are views into the stacked arrays
+        """
+        n_actions = arrays['R'].shape[0]
+        tables = {}
+        for name in ('T', 'Z'):
+            indptr, indices, data = arrays[name + '_indptr'], arrays[name + '_indices'], arrays[name + '_data']
+            shape = tuple(int(n) for n in arrays[name + '_shape'])
+            tables[name] = []
+            for a in range(n_actions):
+                rows = indptr[a * shape[0]:(a + 1) * shape[0] + 1]
+                start, end = rows[0], rows[-1]
+                tables[name].append(CSRMatrix(rows - start, indices[start:end], data[start:end], shape))
+
+        R_specific = {}
+        for a, s, sj, o, value in arrays['R_specific']:
+            R_specific.setdefault((int(a), int(s)), []).append((None if sj < 0 else int(sj),
+                                                                None if o < 0 else int(o), value))
+        return SparseDynamics(tables['T'], tables['Z'], arrays['R'], R_specific)
+
+    @property
+    def nbytes(self):
+        return sum(m.nbytes for m in self.T + self.Z) + self.R.nbytes
+
+    def dense_tables(self, a):
+        return self.T[a].toarray(), self.Z[a].toarray()
+
+    def transition(self, a, si, sj):
+        return self.T[a].get(si, sj)
+
+    def observation(self, a, sj, o):
+        return self.Z[a].get(sj, o)
+
+    def reward(self, a, si, sj=None, o=None):
+        entries = self.R_specific.get((a, si))
+        if sj is None or o is None or entries is None:
+            return self.R[a, si]
+
+        for e_sj, e_o, value in reversed(entries):
+            if (e_sj is None or e_sj == sj) and (e_o is None or e_o == o):
+                return value
+        return 0.0
+
+    def transition_probs(self, a, si):
+        return self.T[a].row(si)
+
+    def observation_probs(self, a, sj):
+        return self.Z[a].row(sj)
+
+    def transition_rows(self):
+        return CSRMatrix.vstack(self.T)
+
+    def observation_rows(self):
+        return CSRMatrix.vstack(self.Z)
+
+    def observation_likelihood(self, a, o):
+        likelihood = np.zeros(self.Z[a].shape[0])
+        states, probs = self.Z[a].T.row(o)
+        likelihood[states] = probs
+        return likelihood
+
+    def observation_likelihoods(self, a, observations):
+        unique, inverse = np.unique(observations, return_inverse=True)
+        return np.array([self.observation_likelihood(a, o) for o in unique]).reshape(len(unique), -1)[inverse]
+
+    def backproject(self, a, o, vectors):
+        weighted = vectors * self.observation_likelihood(a, o)
+        return self.T[a].dot(weighted.T).T
+
+    def backproject_all(self, a, vectors):
+        return np.array([self.backproject(a, o, vectors) for o in range(self.Z[a].shape[1])])
+
+    def propagate(self, a, belief):
+        return self.T[a].rdot(belief)
+
+    def propagate_sparse(self, a, states, probs):
+        return self.T[a].combine_rows(states, probs)
+
+    def observation_probabilities(self, a, states, o):
+        return self.Z[a].column(o, states)
+
+
+def compile_tables(builder, states, actions, observations, T, Z, R):
+    """
+    Feeds name-keyed T, Z and R dictionaries into a DenseBuilder or SparseBuilder
+    """
+    s_idx = {s: i for i, s in enumerate(states)}
+    a_idx = {a: i for i, a in enumerate(actions)}
+    o_idx = {o: i for i, o in enumerate(observations)}
+
+    for (a, si, sj), prob in T.items():
+        builder.set('T', index_of(a_idx, a), index_of(s_idx, si), index_of(s_idx, sj), prob)
+    for (a, sj, o), prob in Z.items():
+        builder.set('Z', index_of(a_idx, a), index_of(s_idx, sj), index_of(o_idx, o), prob)
+    for (a, si, sj, o), value in R.items():
+        builder.set_reward(index_of(a_idx, a), index_of(s_idx, si), index_of(s_idx, sj), index_of(o_idx, o), value)
+    return builder.build()
+
+
+class DenseBuilder(object):
+    """
+    Writes T, Z and R entries straight into preallocated tensors and builds a DenseDynamics.
+    Indices are either integers or slice(None) for a wildcard, values are broadcast over the indexed block.
+    Later entries override earlier ones.
+    """
+    def __init__(self, n_states, n_actions, n_observations):
+        self.n_states, self.n_actions, self.n_observations = n_states, n_actions, n_observations
+        self.tables = {
+            'T': np.zeros((n_actions, n_states, n_states)),
+            'Z': np.zeros((n_actions, n_states, n_observations)),
+        }
+        self.R = np.zeros((n_actions, n_states))
+        self.R_full = None
+
+    def set(self, table, a, i, j, values):
+        """
+        :param table: 'T' (rows are start states, columns next states) or 'Z' (rows are next states, columns observations)
+        """
+        self.tables[table][a, i, j] = values
+
+    def set_identity(self, table, a, cols):
+        """
+        Row i of the table gets probability 1 at column cols[i], rows with cols[i] == -1 are left empty
+        """
+        rows = np.flatnonzero(cols >= 0)
+        self.tables[table][a] = 0.0
+        self.tables[table][a, rows, cols[rows]] = 1.0
+
+    def set_reward(self, a, si, sj, o, values):
+        if self.R_full is None:
+            if sj == slice(None) and o == slice(None) and np.ndim(values) == 0:
+                self.R[a, si] = values
+                return
+            # the first reward depending on s' or o, from now on the full tensor is kept
+            shape = (self.n_actions, self.n_states, self.n_states, self.n_observations)
+            self.R_full = np.ascontiguousarray(np.broadcast_to(self.R[:, :, None, None], shape))
+        self.R_full[a, si, sj, o] = values
+
+    def build(self):
+        T, Z, R = self.tables['T'], self.tables['Z'], self.R
+        if self.R_full is not None:
+            # R(a, s) = sum_{s', o} T(a, s, s') * Z(a, s', o) * R(a, s, s', o)
+            R = np.einsum('ast,ato,asto->as', T, Z, self.R_full)
+        return DenseDynamics(T, Z, R, self.R_full)
+
+
+class SparseBuilder(object):
+    """
+    Same interface as DenseBuilder, but only keeps the non-zero entries row by row and builds a SparseDynamics
+    """
+    def __init__(self, n_states, n_actions, n_observations):
+        self.n_states, self.n_actions, self.n_observations = n_states, n_actions, n_observations
+        self.shapes = {'T': (n_states, n_states), 'Z': (n_states, n_observations)}
+        self.rows = {'T': {}, 'Z': {}}    # (a, row) => {column: value}
+
+        # (a, s) => [(s', o, reward)] in table order for the pairs whose rewards depend on s' or o,
+        # None stands for a wildcard
+        self.R = np.zeros((n_actions, n_states))
+        self.R_specific = {}
+
+    @staticmethod
+    def expand(index, n):
+        return range(n)[index] if isinstance(index, slice) else (index,)
+
+    def set(self, table, a, i, j, values):
+        rows = self.rows[table]
+        if type(a) is int and type(i) is int and type(j) is int:
+            # a single entry, by far the most common case
+            rows.setdefault((a, i), {})[j] = float(values)
+            return
+
+        n_rows, n_cols = self.shapes[table]
+        if type(j) is int and np.ndim(values) == 0:
+            value = float(values)
+            for ai in self.expand(a, self.n_actions):
+                for row in self.expand(i, n_rows):
+                    rows.setdefault((ai, row), {})[j] = value
+            return
+
+        values = np.asarray(values, dtype=np.float64)
+        for ai in self.expand(a, self.n_actions):
+            for k, row in enumerate(self.expand(i, n_rows)):
+                v = values[k] if values.ndim == 2 else values
+                if isinstance(j, slice):
+                    # a whole row is overridden
+                    v = np.broadcast_to(v, (n_cols,))
+                    cols = np.flatnonzero(v)
+                    rows[(ai, row)] = dict(zip(cols.tolist(), v[cols].tolist()))
+                else:
+                    rows.setdefault((ai, row), {})[j] = float(v)
+
+    def set_identity(self, table, a, cols):
+        for ai in self.expand(a, self.n_actions):
+            for row, col in enumerate(cols.tolist()):
+                self.rows[table][(ai, row)] = {col: 1.0} if col >= 0 else {}
+
+    def set_reward(self, a, si, sj, o, values):
+        if np.ndim(values):
+            # a vector over the observations or a matrix over (s', o)
+            values = np.asarray(values, dtype=np.float64)
+            for k, j in enumerate(self.expand(sj, self.n_states)):
+                for oi, value in zip(self.expand(o, self.n_observations), np.atleast_2d(values)[k].tolist()):
+                    self.set_reward(a, si, j, oi, value)
+            return
+
+        for ai in self.expand(a, self.n_actions):
+            for i in self.expand(si, self.n_states):
+                if sj == slice(None) and o == slice(None):
+                    self.R[ai, i] = values
+                    if (ai, i) in self.R_specific:
+                        self.R_specific[(ai, i)].append((None, None, values))
+                else:
+                    entries = self.R_specific.setdefault((ai, i), [(None, None, self.R[ai, i])])
+                    entries.append((None if isinstance(sj, slice) else sj, None if isinstance(o, slice) else o, values))
+
+    def build(self):
+        matrices = {}
+        for table, rows in self.rows.items():
+            triplets = [(ai, row, col, value) for (ai, row), cols in rows.items() for col, value in cols.items()]
+            arr = np.array(triplets, dtype=np.float64).reshape(-1, 4)
+            keys = arr[:, :3].astype(np.int64)
+            matrices[table] = [
+                CSRMatrix.from_triplets(keys[keys[:, 0] == ai, 1], keys[keys[:, 0] == ai, 2],
+                                        arr[keys[:, 0] == ai, 3], self.shapes[table])
+                for ai in range(self.n_actions)
+            ]
+
+        T, Z, R = matrices['T'], matrices['Z'], self.R
+        dynamics = SparseDynamics(T, Z, R, self.R_specific)
+        for (ai, i) in self.R_specific:
+            # R(a, s) = sum_{s', o} T(a, s, s') * Z(a, s', o) * R(a, s, s', o), summed over the supports only
+            expected = 0.0
+            for sj, t_prob in zip(*T[ai].row(i)):
+                for o, z_prob in zip(*Z[ai].row(sj)):
+                    expected += t_prob * z_prob * dynamics.reward(ai, i, sj, o)
+            R[ai, i] = expected
+        return dynamics
@@ -0,0 +1,220 @@
+import itertools
+import random
+import numpy as np
+
+from util import draw_args
+from models.model import Model
+
+
+class Variable(object):
+    """
+    A discrete POMDPX variable. State variables have a name for the current (vnameCurr) and the previous
+    (vnamePrev) time step, the other variables only have one name.
+    """
+    def __init__(self, name, values, prev=None, fully_observed=False):
+        self.name = name
+        self.prev = prev
+        self.values = list(values)
+        self.fully_observed = fully_observed
+        self.index = {v: i for i, v in enumerate(self.values)}
+
+    def __len__(self):
+        return len(self.values)
+
+
+class Factor(object):
+    """
+    Conditional probability table P(var | parents) stored as a dense array with one axis per parent
+    followed by one axis for var. Reward functions have no var, the table then holds the reward values.
+    Variables are referred to by name.
+    """
+    def __init__(self, var, parents, table):
+        self.var = var
+        self.parents = parents
+        self.table = table
+        self.cumulative = None if var is None else np.cumsum(table, axis=-1)
+
+    def sample(self, assignment, positions):
+        """
+        :param assignment: value index of every variable in the model's scope
+        :param positions: scope positions of the parents
+        :return: value index of var
+        """
+        row = self.cumulative[tuple(assignment[p] for p in positions)]
+        return min(int(row.searchsorted(random.random() * row[-1], side='right')), len(row) - 1)
+
+    def sample_many(self, assignments, positions):
+        """
+        Vectorised sample, assignments is a 2D array holding one assignment per row
+        """
+        rows = self.cumulative[tuple(assignments[:, p] for p in positions)]
+        rows = np.broadcast_to(rows, (len(assignments), rows.shape[-1]))
+        u = np.random.random(len(rows)) * rows[:, -1]
+        return np.minimum((rows <= u[:, None]).sum(axis=1), rows.shape[1] - 1)
+
+
+def joint_distribution(variables, factors):
+    """
+    Multiplies factors over the given variables out into a flat distribution over the joint assignments
+    (mixed radix indices, as used by FactoredModel for states). Only meant for initial beliefs.
+    :param variables: [Variable], the factors are expected to refer to their previous time step names
+    """
+    dims = tuple(len(var) for var in variables)
+    values = dict(zip([var.prev for var in variables], np.unravel_index(np.arange(int(np.prod(dims))), dims)))
+    joint = np.ones(int(np.prod(dims)))
+    for factor in factors:
+        joint *= factor.table[tuple(values[v] for v in factor.parents + [factor.var])]
+    return joint / joint.sum()
+
+
+class FactoredModel(Model):
+    """
+    Model of a factored POMDP, as specified by a .POMDPX file. The state is an assignment of the state
+    variables and the observation an assignment of the observation variables, both encoded as integers
+    (mixed radix over the variables in declaration order). The transition, observation and reward functions
+    are kept as per-variable factors and simulated factor by factor, so no flat table is ever built.
+
+    Every sampled quantity lives in a scope vector laid out as
+        [action, previous state variables..., current state variables..., observation variables...]
+    """
+    def __init__(self, env, **kwargs):
+        """
+        Expected attributes in env:
+            model_name
+            model_spec
+            discount
+            values
+            state_variables     [Variable]
+            observation_variables [Variable]
+            action_variable     Variable
+            initial_belief      [Factor] over previous state variables
+            transitions         [Factor] over current state variables
+            observation_factors [Factor] over observation variables
+            rewards             [Factor] without var, summed up
+        """
+        self.model_name = env['model_name']
+        self.model_spec = env['model_spec']
+        self.discount = env['discount']
+        self.values = env.get('values')
+        self.costs = None
+        self.init_state = None
+
+        self.state_variables = env['state_variables']
+        self.observation_variables = env['observation_variables']
+        self.action_variable = env['action_variable']
+
+        n = len(self.state_variables)
+        self.scope = {self.action_variable.name: 0}
+        for i, var in enumerate(self.state_variables):
+            self.scope[var.prev] = 1 + i
+            self.scope[var.name] = 1 + n + i
+        for i, var in enumerate(self.observation_variables):
+            self.scope[var.name] = 1 + 2 * n + i
+        self.prev_slice = slice(1, 1 + n)
+        self.curr_slice = slice(1 + n, 1 + 2 * n)
+        self.obs_slice = slice(1 + 2 * n, len(self.scope))
+
+        self.state_dims = tuple(len(var) for var in self.state_variables)
+        self.obs_dims = tuple(len(var) for var in self.observation_variables)
+        self.initial_belief = self.__bind(env['initial_belief'])
+        self.transitions = self.__bind(env['transitions'])
+        self.observation_factors = self.__bind(env['observation_factors'])
+        self.reward_factors = [(factor, tuple(self.scope[p] for p in factor.parents)) for factor in env['rewards']]
+
+        self.actions = list(self.action_variable.values)
+        self.observations = [' '.join(values) for values in
+                             itertools.product(*[var.values for var in self.observation_variables])]
+        self.action_idx = {a: i for i, a in enumerate(self.actions)}
+        self.obs_idx = {o: i for i, o in enumerate(self.observations)}
+        self.action_costs = [0] * len(self.actions)
+        self.action_indices = list(range(len(self.actions)))
+
+        self.curr_state = self.state_name(self.gen_particles(1)[0])
+
+    def __bind(self, factors):
+        """
+        Resolves the factors' variables into scope positions and orders them so that every factor comes
+        after the factors producing its parents
+        :return: [(scope position of var, parent positions, factor)]
+        """
+        pending = [(self.scope[f.var], tuple(self.scope[p] for p in f.parents), f) for f in factors]
+        produced = {pos for pos, _, _ in pending}
+        ordered, ready = [], set()
+        while pending:
+            remaining = [(pos, parents, f) for pos, parents, f in pending
+                         if any(p in produced and p not in ready for p in parents)]
+            if len(remaining) == len(pending):
+                raise ValueError('Cyclic dependencies between factors of ' + ', '.join(f.var for _, _, f in pending))
+            ordered += [item for item in pending if item not in remaining]
+            ready.update(pos for pos, _, _ in ordered)
+            pending = remaining
+        return ordered
+
+    @property
+    def num_states(self):
+        return int(np.prod(self.state_dims))
+
+    def state_name(self, s):
+        values = np.unravel_index(s, self.state_dims)
+        return ' '.join(var.values[v] for var, v in zip(self.state_variables, values))
+
+    def state_index(self, name):
+        values = [var.index[v] for var, v in zip(self.state_variables, name.split())]
+        return int(np.ravel_multi_index(values, self.state_dims))
+
+    def __assignments(self, states, actions):
+        assignments = np.zeros((len(states), len(self.scope)), dtype=np.int64)
+        assignments[:, 0] = actions
+        assignments[:, self.prev_slice] = np.array(np.unravel_index(states, self.state_dims)).T
+        return assignments
+
+    def gen_particles(self, n, prob=None):
+        """
+        :return: n state indices sampled from prob, or from the initial belief factors when prob is None
+        """
+        if prob is not None:
+            return draw_args(prob, n).tolist()
+
+        assignments = np.zeros((n, len(self.scope)), dtype=np.int64)
+        for pos, parents, factor in self.initial_belief:
+            assignments[:, pos] = factor.sample_many(assignments, parents)
+        return np.ravel_multi_index(tuple(assignments[:, self.prev_slice].T), self.state_dims).tolist()
+
+    def simulate_action_index(self, s, a):
+        assignment = [0] * len(self.scope)
+        assignment[0] = a
+        assignment[self.prev_slice] = np.unravel_index(s, self.state_dims)
+
+        for pos, parents, factor in self.transitions:
+            assignment[pos] = factor.sample(assignment, parents)
+        for pos, parents, factor in self.observation_factors:
+            assignment[pos] = factor.sample(assignment, parents)
+
+        sj = int(np.ravel_multi_index(assignment[self.curr_slice], self.state_dims))
+        oj = int(np.ravel_multi_index(assignment[self.obs_slice], self.obs_dims))
+        reward = sum(factor.table[tuple(assignment[p] for p in parents)] for factor, parents in self.reward_factors)
+        return sj, oj, reward, 0
+
+    def simulate_actions(self, states, actions):
+        states = np.asarray(states, dtype=np.int64)
+        assignments = self.__assignments(states, actions)
+
+        for pos, parents, factor in self.transitions:
+            assignments[:, pos] = factor.sample_many(assignments, parents)
+        for pos, parents, factor in self.observation_factors:
+            assignments[:, pos] = factor.sample_many(assignments, parents)
+
+        next_states = np.ravel_multi_index(tuple(assignments[:, self.curr_slice].T), self.state_dims)
+        observations = np.ravel_multi_index(tuple(assignments[:, self.obs_slice].T), self.obs_dims)
+        rewards = np.zeros(len(states))
+        for factor, parents in self.reward_factors:
+            rewards += factor.table[tuple(assignments[:, p] for p in parents)]
+        return next_states, observations, rewards, np.zeros(len(states))
+
+    def print_config(self):
+        print("discount:", self.discount)
+        print("state variables:", [(var.name, len(var)) for var in self.state_variables])
+        print("actions:", self.actions)
+        print("observations:", self.observations)
+        print("number of states:", self.num_states)
+        print("")
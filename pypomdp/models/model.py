@@ -1,11 +1,15 @@
 
+import hashlib
 from abc import abstractmethod
-from util import draw_arg
+from util import draw_args
+from util.alias_table import AliasTable
+from util.shared_arrays import SharedArrays
+from models.dynamics import DenseDynamics, SparseDynamics
 import numpy as np
 
 
 class Model(object):
-    def __init__(self, env):
+    def __init__(self, env, sparse=False):
         """
         Expected attributes in env:
             model_name
@@ -19,12 +23,110 @@ class Model(object):
             T
             Z
             R
+        The T, Z and R tables are compiled into integer-indexed tensors (see models.dynamics) once here,
+        the name-keyed dictionaries are not kept around. An env may instead carry already compiled dynamics,
+        as produced by the PomdpParser, or the SharedArrays holding all of the model's tensors (see share)
+        under 'shared', in place of T, Z and R.
+
+        :param sparse: store T and Z as per-action CSR matrices instead of dense tensors, ignored when the
+        env's dynamics are already compiled
         """
         for k, v in env.items():
-            self.__dict__[k] = v
+            if k not in ('T', 'Z', 'R', 'dynamics', 'shared'):
+                self.__dict__[k] = v
+
+        self.state_idx = {s: i for i, s in enumerate(self.states)}
+        self.action_idx = {a: i for i, a in enumerate(self.actions)}
+        self.obs_idx = {o: i for i, o in enumerate(self.observations)}
+        self.shared = None
+        if env.get('shared') is not None:
+            self.__attach(env['shared'])
+        else:
+            if env.get('dynamics') is not None:
+                self.dynamics = env['dynamics']
+            else:
+                dynamics_cls = SparseDynamics if sparse else DenseDynamics
+                self.dynamics = dynamics_cls.from_tables(self.states, self.actions, self.observations,
+                                                        env['T'], env['Z'], env['R'])
+
+            # alias samplers, row a * |S| + s draws from T(a, s, .) and Z(a, s, .) respectively
+            self.transition_sampler = AliasTable.from_csr(self.dynamics.transition_rows())
+            self.observation_sampler = AliasTable.from_csr(self.dynamics.observation_rows())
+            self.rewards = memoryview(np.ascontiguousarray(self.dynamics.R).ravel())
+        self.action_costs = [self.cost_function(a) for a in self.actions]
+        self.action_indices = list(range(len(self.actions)))
 
         self.curr_state = self.init_state or np.random.choice(self.states)
 
+    def __getstate__(self):
+        # memoryviews cannot be pickled, they are rebuilt when unpickling (e.g. in worker processes)
+        state = self.__dict__.copy()
+        state.pop('rewards', None)
+        if state.get('shared') is not None:
+            # shared tensors are attached to again rather than copied
+            for k in ('dynamics', 'transition_sampler', 'observation_sampler'):
+                del state[k]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get('shared') is not None:
+            self.__attach(state['shared'])
+        elif 'dynamics' in state:
+            self.rewards = memoryview(np.ascontiguousarray(self.dynamics.R).ravel())
+
+    def tensors(self):
+        """
+        :return: every array of the dynamics and the alias samplers, by name
+        """
+        arrays = {'dynamics.' + k: v for k, v in self.dynamics.to_arrays().items()}
+        for sampler in ('transition_sampler', 'observation_sampler'):
+            for field in AliasTable.FIELDS:
+                arrays[sampler + '.' + field] = getattr(getattr(self, sampler), field)
+        return arrays
+
+    def fingerprint(self):
+        """
+        :return: hex digest identifying the model by its names, discount, transition and observation
+        probabilities and expected rewards, whether the dynamics are stored dense or sparse
+        """
+        digest = hashlib.sha1()
+        for names in (self.states, self.actions, self.observations):
+            digest.update('\0'.join(map(str, names)).encode() + b'\1')
+        digest.update(repr(float(self.discount)).encode())
+        tables = [np.asarray(self.dynamics.R)]
+        for a in range(len(self.actions)):
+            tables.extend(self.dynamics.dense_tables(a))
+        for arr in tables:
+            digest.update(np.ascontiguousarray(arr, dtype=np.float64))
+        return digest.hexdigest()
+
+    def share(self, folder=None):
+        """
+        Moves the model's tensors into a shared memory block, or into read-only memory-mapped .npy files
+        when a folder is given, and uses them from there. Pickled copies of the model (e.g. sent to worker
+        processes) then attach to the same physical memory instead of carrying their own copy.
+        :return: the SharedArrays, the caller is responsible for unlinking a shared memory block
+        """
+        arrays = self.tensors()
+        shared = SharedArrays.create(arrays) if folder is None else SharedArrays.save(folder, arrays)
+        self.__attach(shared)
+        return shared
+
+    def __attach(self, shared):
+        """
+        Rebuilds the dynamics and the alias samplers as views into the given SharedArrays
+        """
+        def prefixed(prefix):
+            return {k[len(prefix):]: v for k, v in shared.items() if k.startswith(prefix)}
+
+        dynamics = prefixed('dynamics.')
+        self.shared = shared
+        self.dynamics = (SparseDynamics if 'T_indptr' in dynamics else DenseDynamics).from_arrays(dynamics)
+        self.transition_sampler = AliasTable(**prefixed('transition_sampler.'))
+        self.observation_sampler = AliasTable(**prefixed('observation_sampler.'))
+        self.rewards = memoryview(np.ascontiguousarray(self.dynamics.R).ravel())
+
     @property
     def num_states(self):
         return len(self.states)
@@ -33,12 +135,28 @@ class Model(object):
     def num_actions(self):
         return len(self.actions)
 
+    @property
+    def num_observations(self):
+        return len(self.observations)
+
+    def state_name(self, s):
+        """
+        :return: the name of the state with index s
+        """
+        return self.states[s]
+
+    def state_index(self, name):
+        return self.state_idx[name]
+
     def gen_particles(self, n, prob=None):
+        """
+        :return: n state indices sampled from prob
+        """
         if prob is None:
             # by default use uniform distribution for particles generation
             prob = [1 / len(self.states)] * len(self.states)
 
-        return [self.states[draw_arg(prob)] for i in range(n)]
+        return draw_args(prob, n).tolist()
 
     def get_legal_actions(self, state):
         """
@@ -49,20 +167,68 @@ class Model(object):
         """
         return self.actions
 
+    def get_legal_action_indices(self, s):
+        """
+        Index version of get_legal_actions, models restricting the legal actions must override both
+        :param s: state index
+        :return: indices of the actions selectable at the given state
+        """
+        return self.action_indices
+
     def observation_function(self, action, state, obs):
-        return self.Z.get((action, state, obs), 0.0)
+        return self.dynamics.observation(self.action_idx[action], self.state_idx[state], self.obs_idx[obs])
 
     def transition_function(self, action, si, sj):
-        return self.T.get((action, si, sj), 0.0)
+        return self.dynamics.transition(self.action_idx[action], self.state_idx[si], self.state_idx[sj])
 
-    def reward_function(self, action='*', si='*', sj='*', obs='*'):
-        return self.R.get((action, si, sj, obs), 0.0)
+    def reward_function(self, action, si, sj='*', obs='*'):
+        """
+        R(a, s) when sj or obs is left as a wildcard, otherwise R(a, s, s', o)
+        """
+        if sj == '*' or obs == '*':
+            return self.dynamics.reward(self.action_idx[action], self.state_idx[si])
+        return self.dynamics.reward(self.action_idx[action], self.state_idx[si],
+                                    self.state_idx[sj], self.obs_idx[obs])
 
     def cost_function(self, action):
         if not self.costs:
             return 0
         return self.costs[self.actions.index(action)]
 
+    def simulate_action_index(self, s, a):
+        """
+        Same as simulate_action, but states, actions and observations are given by their indices.
+        Every draw is an O(1) alias table lookup.
+
+        s: current state index
+        a: action index
+        return: next state index, observation index, reward and cost
+        """
+        n = len(self.states)
+        sj = self.transition_sampler.draw(a * n + s)
+        oj = self.observation_sampler.draw(a * n + sj)
+
+        # R(a, s) is the expectation of R(a, s, s', o) over s' and o
+        return sj, oj, self.rewards[a * n + s], self.action_costs[a]
+
+    def simulate_actions(self, states, actions):
+        """
+        Batched simulate_action_index: simulates one step for every particle in a single vectorised call
+
+        states: array of state indices
+        actions: a single action index applied to every state, or an array with one action index per state
+        return: arrays of next state indices, observation indices, rewards and costs
+        """
+        states = np.asarray(states, dtype=np.int64)
+        actions = np.broadcast_to(np.asarray(actions, dtype=np.int64), states.shape)
+
+        n = len(self.states)
+        next_states = self.transition_sampler.draw_many(actions * n + states)
+        observations = self.observation_sampler.draw_many(actions * n + next_states)
+        rewards = self.dynamics.R[actions, states]
+        costs = np.asarray(self.action_costs)[actions]
+        return next_states, observations, rewards, costs
+
     def simulate_action(self, si, ai, debug=False):
         """
         Query the resultant new state, observation and rewards, if action ai is taken from state si
@@ -71,25 +237,15 @@ class Model(object):
         ai: action taken at the current state
         return: next state, observation and reward
         """
-        # get new state
-        s_probs = [self.transition_function(ai, si, sj) for sj in self.states]
-        state = self.states[draw_arg(s_probs)]
-
-        # get new observation
-        o_probs = [self.observation_function(ai, state, oj) for oj in self.observations]
-        observation = self.observations[draw_arg(o_probs)]
+        a, s = self.action_idx[ai], self.state_index(si)
+        sj, oj, reward, cost = self.simulate_action_index(s, a)
 
         if debug:
             print('taking action {} at state {}'.format(ai ,si))
-            print('transition probs: {}'.format(s_probs))
-            print('obs probs: {}'.format(o_probs))
+            print('transition probs: {}'.format(self.dynamics.transition_probs(a, s)))
+            print('obs probs: {}'.format(self.dynamics.observation_probs(a, sj)))
 
-        # get new reward
-        # reward = self.reward_function(ai, si, sj, observation) #  --- THIS IS MORE GENERAL!
-        reward = self.reward_function(ai, si)   # --- THIS IS TMP SOLUTION!
-        cost = self.cost_function(ai)
-
-        return state, observation, reward, cost
+        return self.state_name(sj), self.observations[oj], reward, cost
 
     def take_action(self, action):
         """
@@ -110,9 +266,9 @@ class Model(object):
         print("actions:", self.actions)
         print("observations:", self.observations)
         print("")
-        print("T:", self.T)
+        print("T:", self.dynamics.T)
         print("")
-        print("Z:", self.Z)
+        print("Z:", self.dynamics.Z)
         print("")
-        print("R:", self.R)
+        print("R:", self.dynamics.R)
         print("")
@@ -1,8 +1,185 @@
+import random
+import numpy as np
+
 from models.model import Model
 
+
 class RockSampleModel(Model):
-    def __init__(self, env):
-        Model.__init__(self, env)
+    """
+    Procedural RockSample(n, k): a rover on an n x n grid with k rocks of unknown quality, following the
+    dynamics of the shipped RockSample .POMDPX files. Moving west, north or south off the grid and sampling
+    where there is no rock end the episode with -100, moving east off the grid exits with +10. Sampling a
+    rock yields +10 if it is good and -10 otherwise, and leaves it bad. Checking a rock returns its true
+    quality with an accuracy decaying with the distance, 0.5 + 0.5 * 2 ^ (-d / half_efficiency_distance).
+
+    No table is built: a state is the integer (cell << k) | rock bitmask, with cell = x * n + y, plus one
+    terminal state n * n * 2^k, and actions are simulated arithmetically. The memory used is independent
+    of the number of states, so it serves as a black-box simulator for POMCP on instances too large
+    for any of the tabular solvers.
+    """
+    MOVES = ((0, 1), (1, 0), (0, -1), (-1, 0))
+    NONE, GOOD, BAD = 0, 1, 2
+
+    def __init__(self, env, **kwargs):
+        """
+        Expected attributes in env:
+            model_name
+            model_spec          'NxK', grid size and number of rocks
+        optional:
+            discount            0.95 by default
+            rocks               [(x, y)], otherwise k distinct cells are drawn using seed
+            seed
+            start               (x, y), (0, n // 2) by default
+            half_efficiency_distance
+        """
+        self.model_name = env['model_name']
+        self.model_spec = env['model_spec']
+        self.discount = env.get('discount', 0.95)
+        self.values = 'reward'
+        self.costs = None
+        self.init_state = None
+
         size, num_rocks = self.model_spec.split('x')
         self.size = int(size)
         self.num_rocks = int(num_rocks)
+        if self.num_rocks < 1:
+            raise ValueError('RockSample needs at least one rock, got {}'.format(self.model_spec))
+        if self.num_rocks > self.size * self.size:
+            raise ValueError('Cannot place {} rocks on a {}x{} grid'.format(self.num_rocks, self.size, self.size))
+
+        if env.get('rocks') is not None:
+            self.rocks = [tuple(rock) for rock in env['rocks']]
+        else:
+            cells = np.random.RandomState(env.get('seed', 0)).choice(self.size * self.size, self.num_rocks,
+                                                                    replace=False)
+            self.rocks = [divmod(int(cell), self.size) for cell in cells]
+        self.start = tuple(env.get('start', (0, self.size // 2)))
+
+        # rock_at[cell] is the rock lying at a cell or -1, efficiency[cell, i] the accuracy of checking rock i
+        n, k = self.size, self.num_rocks
+        xs, ys = np.divmod(np.arange(n * n), n)
+        self.rock_at = np.full(n * n, -1, dtype=np.int64)
+        for i, (x, y) in enumerate(self.rocks):
+            self.rock_at[x * n + y] = i
+        distance = np.hypot(xs[:, None] - np.array([x for x, _ in self.rocks]),
+                            ys[:, None] - np.array([y for _, y in self.rocks]))
+        self.efficiency = 0.5 + 0.5 * 2 ** (-distance / env.get('half_efficiency_distance', 20))
+        self.terminal = n * n << k
+
+        self.actions = ['amn', 'ame', 'ams', 'amw', 'as'] + ['ac{}'.format(i) for i in range(k)]
+        self.observations = ['none', 'good', 'bad']
+        self.action_idx = {a: i for i, a in enumerate(self.actions)}
+        self.obs_idx = {o: i for i, o in enumerate(self.observations)}
+        self.action_costs = [0] * len(self.actions)
+        self.action_indices = list(range(len(self.actions)))
+
+        self.curr_state = self.state_name(self.gen_particles(1)[0])
+
+    @property
+    def num_states(self):
+        return self.terminal + 1
+
+    def state_name(self, s):
+        if s == self.terminal:
+            return 'st'
+        x, y = divmod(s >> self.num_rocks, self.size)
+        return '{}_{} {}'.format(x, y, ''.join('g' if s >> i & 1 else 'b' for i in range(self.num_rocks)))
+
+    def state_index(self, name):
+        if name == 'st':
+            return self.terminal
+        cell, rocks = name.split(' ')
+        x, y = map(int, cell.split('_'))
+        mask = sum(1 << i for i, quality in enumerate(rocks) if quality == 'g')
+        return (x * self.size + y) << self.num_rocks | mask
+
+    def gen_particles(self, n, prob=None):
+        """
+        :return: n state indices sampled from prob, or from the initial belief when prob is None:
+        the rover at its starting cell and every rock equally likely to be good or bad
+        """
+        if prob is not None:
+            return Model.gen_particles(self, n, prob)
+
+        cell = self.start[0] * self.size + self.start[1]
+        masks = np.random.randint(0, 1 << self.num_rocks, n, dtype=np.int64)
+        return ((cell << self.num_rocks) | masks).tolist()
+
+    def simulate_action_index(self, s, a):
+        if s == self.terminal:
+            return s, self.NONE, 0, 0
+
+        k = self.num_rocks
+        cell, rocks = s >> k, s & ((1 << k) - 1)
+
+        if a < 4:
+            x, y = divmod(cell, self.size)
+            dx, dy = self.MOVES[a]
+            x, y = x + dx, y + dy
+            if not (0 <= x < self.size and 0 <= y < self.size):
+                return self.terminal, self.NONE, 10 if x == self.size else -100, 0
+            return (x * self.size + y) << k | rocks, self.NONE, 0, 0
+
+        if a == 4:
+            rock = self.rock_at[cell]
+            if rock < 0:
+                return self.terminal, self.NONE, -100, 0
+            reward = 10 if rocks >> rock & 1 else -10
+            return s & ~(1 << int(rock)), self.NONE, reward, 0
+
+        rock = a - 5
+        good = rocks >> rock & 1
+        if random.random() >= self.efficiency[cell, rock]:
+            good = not good
+        return s, self.GOOD if good else self.BAD, 0, 0
+
+    def simulate_actions(self, states, actions):
+        states = np.asarray(states, dtype=np.int64)
+        actions = np.broadcast_to(np.asarray(actions, dtype=np.int64), states.shape)
+
+        k, n = self.num_rocks, self.size
+        terminal = states == self.terminal
+        cells, rocks = np.minimum(states >> k, n * n - 1), states & ((1 << k) - 1)
+        x, y = np.divmod(cells, n)
+        next_states = states.copy()
+        observations = np.full(len(states), self.NONE, dtype=np.int64)
+        rewards = np.zeros(len(states))
+
+        # moves
+        moves = np.array(self.MOVES + ((0, 0),) * (len(self.actions) - 4))
+        x, y = x + moves[actions, 0], y + moves[actions, 1]
+        moving = (actions < 4) & ~terminal
+        inside = (0 <= x) & (x < n) & (0 <= y) & (y < n)
+        next_states[moving & inside] = (((x * n + y) << k) | rocks)[moving & inside]
+        next_states[moving & ~inside] = self.terminal
+        rewards[moving & ~inside] = np.where(x == n, 10, -100)[moving & ~inside]
+
+        # sampling
+        sampling = (actions == 4) & ~terminal
+        rock = self.rock_at[cells]
+        missed = sampling & (rock < 0)
+        sampled = sampling & (rock >= 0)
+        bits = np.left_shift(1, np.maximum(rock, 0))
+        next_states[missed] = self.terminal
+        rewards[missed] = -100
+        rewards[sampled] = np.where(rocks & bits, 10, -10)[sampled]
+        next_states[sampled] &= ~bits[sampled]
+
+        # checking
+        checking = (actions > 4) & ~terminal
+        rock = np.maximum(actions - 5, 0)
+        good = (rocks >> rock & 1).astype(bool)
+        correct = np.random.random(len(states)) < self.efficiency[cells, rock]
+        observations[checking] = np.where(good == correct, self.GOOD, self.BAD)[checking]
+
+        return next_states, observations, rewards, np.zeros(len(states))
+
+    def print_config(self):
+        print("discount:", self.discount)
+        print("grid size:", self.size)
+        print("rocks:", self.rocks)
+        print("start:", self.start)
+        print("actions:", self.actions)
+        print("observations:", self.observations)
+        print("number of states:", self.num_states)
+        print("")
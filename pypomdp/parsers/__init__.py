@@ -1,4 +1,4 @@
-
 from .env_parser import PomdpxParser
 from .env_parser import PomdpParser
+from .env_parser import ProceduralEnv
 from .tree_visualiser import GraphViz
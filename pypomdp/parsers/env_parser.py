@@ -3,352 +3,409 @@
     https://github.com/mbforbes/py-pomdp/blob/master/pomdp.py
 """
 
-from copy import deepcopy
+from collections import deque
 from numpy import *
 from util.helper import gen_distribution
 from numpy import random
+from models.dynamics import index_of, DenseBuilder, SparseBuilder
+from models.factored_model import Variable, Factor, joint_distribution
+from parsers import model_cache
+from xml.etree import ElementTree
 import os
-import itertools
 
 
 class PomdpxParser:
-    # TODO
-    pass
+    """
+    Parses .pomdpx files (the XML format of APPL) into a factored model description, see
+    models.factored_model. Every CondProb / Func becomes one Factor holding a dense table over its own
+    variable and parents only, the flat state space is never enumerated.
+    Only tabular ("TBL") parameters are supported.
+    """
+    PREFIXES = {'StateVar': 's', 'ObsVar': 'o', 'ActionVar': 'a'}
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.model_name = None
+        self.model_spec = None
+
+        self.discount, self.values = None, 'reward'
+        self.variables = {}      # variable name (both time steps for state variables) => Variable
+        self.state_variables, self.observation_variables, self.action_variable = [], [], None
+        self.initial_belief, self.transitions, self.observation_factors, self.rewards = [], [], [], []
+
+    def __enter__(self):
+        self.model_name, self.model_spec = PomdpParser.split_model_name(self.config_file)
+        root = ElementTree.parse(self.config_file).getroot()
+
+        self.discount = float(root.findtext('Discount'))
+        self.__get_variables(root.find('Variable'))
+        self.initial_belief = [self.__get_factor(e) for e in root.iterfind('InitialStateBelief/CondProb')]
+        self.transitions = [self.__get_factor(e) for e in root.iterfind('StateTransitionFunction/CondProb')]
+        self.observation_factors = [self.__get_factor(e) for e in root.iterfind('ObsFunction/CondProb')]
+        self.rewards = [self.__get_factor(e) for e in root.iterfind('RewardFunction/Func')]
+        return self
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        self = None
+
+    def __get_variables(self, element):
+        for child in element:
+            if child.tag == 'RewardVar':
+                continue
+            if child.tag not in self.PREFIXES:
+                raise Exception('Unrecognized variable: ' + child.tag)
+
+            if child.find('ValueEnum') is not None:
+                values = child.findtext('ValueEnum').split()
+            else:
+                values = ['{}{}'.format(self.PREFIXES[child.tag], i) for i in range(int(child.findtext('NumValues')))]
+
+            if child.tag == 'StateVar':
+                var = Variable(child.get('vnameCurr'), values, prev=child.get('vnamePrev'),
+                               fully_observed=child.get('fullyObs') == 'true')
+                self.state_variables.append(var)
+                self.variables[var.prev] = var
+            elif child.tag == 'ObsVar':
+                var = Variable(child.get('vname'), values)
+                self.observation_variables.append(var)
+            else:
+                if self.action_variable is not None:
+                    raise Exception('Only one action variable is supported')
+                var = self.action_variable = Variable(child.get('vname'), values)
+            self.variables[var.name] = var
+
+    def __get_factor(self, element):
+        """
+        Builds the table of a CondProb (P(Var | Parent)) or a Func (reward of Parent) element.
+        Each Entry's Instance names one value per parent (and var), where '*' stands for every value and
+        the '-' positions are enumerated by the ProbTable / ValueTable in row-major order.
+        Later entries override earlier ones.
+        """
+        is_func = element.tag == 'Func'
+        var = element.findtext('Var').strip()
+        parents = element.findtext('Parent').split()
+        parents = [] if parents == ['null'] else parents
+        axes = parents if is_func else parents + [var]
+        table = zeros(tuple(len(self.variables[v]) for v in axes))
+
+        parameter = element.find('Parameter')
+        if parameter.get('type', 'TBL').strip() != 'TBL':
+            raise Exception('Unsupported parameter type: ' + parameter.get('type'))
+
+        for entry in parameter.iterfind('Entry'):
+            tokens = entry.findtext('Instance').split()
+            values = entry.findtext('ValueTable' if is_func else 'ProbTable').split()
+            if len(tokens) != len(axes):
+                raise Exception('Instance "{}" does not match {}'.format(' '.join(tokens), ' '.join(axes)))
+
+            index, shape, enumerated = [], [], []
+            for token, v in zip(tokens, axes):
+                variable = self.variables[v]
+                if token in ('*', '-'):
+                    index.append(slice(None))
+                    shape.append(len(variable) if token == '-' else 1)
+                    if token == '-':
+                        enumerated.append(len(variable))
+                else:
+                    index.append(variable.index[token])
+
+            if values == ['uniform']:
+                table[tuple(index)] = 1.0 / table.shape[-1]
+            elif values == ['identity']:
+                table[tuple(index)] = eye(enumerated[0]).reshape(shape)
+            else:
+                table[tuple(index)] = array(values, dtype=float).reshape(shape)
+
+        return Factor(None if is_func else var, parents, table)
+
+    def copy_env(self):
+        return {
+            "model_name": self.model_name,
+            "model_spec": self.model_spec,
+            "discount": self.discount,
+            "values": self.values,
+            "state_variables": self.state_variables,
+            "observation_variables": self.observation_variables,
+            "action_variable": self.action_variable,
+            "initial_belief": self.initial_belief,
+            "transitions": self.transitions,
+            "observation_factors": self.observation_factors,
+            "rewards": self.rewards,
+        }
+
+    def random_beliefs(self):
+        return gen_distribution(int(prod([len(var) for var in self.state_variables])))
+
+    def generate_beliefs(self):
+        return joint_distribution(self.state_variables, self.initial_belief)
+
+    def generate_belief_points(self, stepsize):
+        raise ValueError('PBVI needs the flat tables of a .POMDP model')
+
+
+class Tokenizer(object):
+    """
+    Streams the tokens of a .POMDP file, i.e. whitespace separated words where ':' is always a token of its own.
+    Comments are skipped and the file is read line by line.
+    """
+    def __init__(self, f):
+        self.lines = iter(f)
+        self.buffer = deque()
+
+    def peek(self, k=0):
+        """
+        :return: the k-th token ahead without consuming it, None at the end of the file
+        """
+        buffer = self.buffer
+        while len(buffer) <= k:
+            line = next(self.lines, None)
+            if line is None:
+                buffer.append(None)
+            else:
+                buffer.extend(line.split('#', 1)[0].replace(':', ' : ').split())
+        return buffer[k]
+
+    def next(self):
+        if not self.buffer:
+            self.peek()
+        return self.buffer.popleft()
+
+    def expect(self, token):
+        if self.next() != token:
+            raise Exception('Expected "{}" before: {}'.format(token, self.peek()))
+
+    def numbers(self, n):
+        return array([float(self.next()) for _ in range(n)])
 
 
 class PomdpParser:
-    def __init__(self, config_file):
+    KEYWORDS = ('init_state', 'start', 'discount', 'values', 'states', 'actions', 'costs', 'observations', 'T', 'O', 'R')
+
+    def __init__(self, config_file, sparse=False, cache_dir=None):
         '''
         Parses .pomdp file and loads info into this object's fields.
+        The file is streamed once and the T, O and R entries are written straight into integer-indexed arrays
+        (see models.dynamics), so no name-keyed tables are built.
+
+        :param sparse: compile T and O into per-action CSR matrices instead of dense tensors
+        :param cache_dir: where compiled models are cached (see parsers.model_cache), None to always parse
         '''
         self.config_file = config_file
+        self.sparse = sparse
+        self.cache_dir = cache_dir
         self.model_name = None
         self.model_spec = None
 
-        self.T, self.Z, self.R = {}, {}, {}
-        self.discount, self.start, self.init_state = None, None, None
+        self.builder, self.dynamics = None, None
+        self.s_idx, self.a_idx, self.o_idx = None, None, None
+        self.discount, self.start, self.init_state, self.values = None, None, None, None
         self.states, self.actions, self.observations, self.costs = None, None, None, None
 
     def __enter__(self):
-        attrs = ['init_state', 'start', 'discount', 'values', 'states', 'actions', 'costs', 'observations', 'T', 'O', 'R']
+        self.model_name, self.model_spec = self.split_model_name(self.config_file)
+
+        cached = None
+        if self.cache_dir is not None:
+            cached = model_cache.cache_file(self.cache_dir, self.config_file, self.sparse)
+            if os.path.exists(cached):
+                try:
+                    self.__dict__.update(model_cache.load(cached))
+                    return self
+                except (OSError, ValueError, KeyError):
+                    pass    # unreadable cache file, parse again and overwrite it
 
         with open(self.config_file, 'r') as f:
-            self.contents = [
-                x.strip() for x in f.readlines()
-                if not x.startswith("#") and not x.isspace()
-            ]
-            self.__get_model()
-
-            # go through line by line and extract configurations
-            i = 0
-            while i < len(self.contents):
-                line = self.contents[i]
-                attr = [a for a in attrs if line.startswith(a)]
-
-                if not attr:
-                    raise Exception("Unrecognized line: " + line)
-                i = getattr(self, '_PomdpParser__get_' + attr[0])(i)
-
+            tokens = Tokenizer(f)
+            while tokens.peek() is not None:
+                attr = tokens.peek()
+                if attr not in self.KEYWORDS:
+                    raise Exception("Unrecognized token: " + attr)
+                getattr(self, '_PomdpParser__get_' + attr)(tokens)
+
+        if self.builder is not None:
+            self.dynamics = self.builder.build()
+            self.builder = None
+        if cached is not None:
+            model_cache.save(cached, self.copy_env())
         return self
 
     def __exit__(self, ctx_type, ctx_value, ctx_traceback):
         self = None
 
-    def __get_model(self):
-        fname = os.path.basename(self.config_file)
+    @staticmethod
+    def split_model_name(config_file):
+        """
+        :return: model name and spec from a file name such as RockSample-7_8.pomdpx
+        """
+        fname = os.path.basename(config_file)
         if '-' in fname:
             name, spec = fname.split('-')
-            self.model_spec = spec.split('.')[0]
-            self.model_name = name.split('.')[0]
-        else:
-            self.model_name = fname.split('.')[0]
-
-    def __get_discount(self, i):
-        line = self.contents[i]
-        self.discount = float(line.split()[1])
-        return i + 1
-
-    def __get_values(self, i):
+            return name.split('.')[0], spec.split('.')[0]
+        return fname.split('.')[0], None
+
+    def __parse_list__(self, tokens, attr):
+        """
+        Reads '<attr>: <names or count>' and returns the names
+        """
+        tokens.expect(attr)
+        tokens.expect(':')
+        items = []
+        # the list ends where the next '<keyword>:' or 'start include/exclude:' begins
+        while tokens.peek() is not None and tokens.peek(1) != ':' and \
+                not (tokens.peek() == 'start' and tokens.peek(1) in ('include', 'exclude')):
+            items.append(tokens.next())
+
+        if len(items) == 1 and items[0].isdigit() and attr in ('states', 'actions', 'observations'):
+            return list(map(str, range(int(items[0]))))
+        return items
+
+    def __get_discount(self, tokens):
+        self.discount = float(self.__parse_list__(tokens, 'discount')[0])
+
+    def __get_values(self, tokens):
         # Currently just supports "values: reward". I.e. currently
         # meaningless.
-        line = self.contents[i]
-        self.values = line.split()[1]
-        return i + 1
-
-    def __parse_line__(self, i, attr):
-        parts = self.contents[i].split()
-
-        if len(parts) == 2:
-            n = int(parts[1])
-            setattr(self, attr, list(map(str, list(range(n)))))
+        self.values = self.__parse_list__(tokens, 'values')[0]
+
+    def __get_init_state(self, tokens):
+        self.init_state = self.__parse_list__(tokens, 'init_state')[0]
+
+    def __get_states(self, tokens):
+        self.states = self.__parse_list__(tokens, 'states')
+
+    def __get_actions(self, tokens):
+        self.actions = self.__parse_list__(tokens, 'actions')
+
+    def __get_observations(self, tokens):
+        self.observations = self.__parse_list__(tokens, 'observations')
+
+    def __get_costs(self, tokens):
+        self.costs = list(map(float, self.__parse_list__(tokens, 'costs')))
+
+    def __get_start(self, tokens):
+        n = len(self.states)
+        if tokens.peek(1) in ('include', 'exclude'):
+            # start include: <states>  |  start exclude: <states>
+            tokens.next()
+            mode = tokens.peek()
+            included = set(self.__parse_list__(tokens, mode))
+            if mode == 'exclude':
+                included = set(self.states) - included
+            self.start = [1.0 / len(included) if s in included else 0.0 for s in self.states]
+            return
+
+        items = self.__parse_list__(tokens, 'start')
+        if items == ['uniform']:
+            self.start = [1.0 / n] * n
+        elif len(items) == 1 and n > 1:
+            # start: <state>
+            self.start = [1.0 if s == items[0] else 0.0 for s in self.states]
         else:
-            setattr(self, attr, parts[1:])
-        return i + 1
-
-    def __get_init_state(self, i):
-        line = self.contents[i]
-        self.init_state = line.split()[1]
-        return i + 1
-
-    def __get_states(self, i):
-        return self.__parse_line__(i, 'states')
-
-    def __get_actions(self, i):
-        return self.__parse_line__(i, 'actions')
-
-    def __get_observations(self, i):
-        return self.__parse_line__(i, 'observations')
-    
-    def __get_start(self, i):
-        j = self.__parse_line__(i, 'start')
-        self.start = list(map(float, self.start))
-        return j
-
-    def __get_costs(self, i):
-        j = self.__parse_line__(i, 'costs')
-        self.costs = list(map(float, self.costs))
-        return j
-
-    def __get_T(self, i):
-        line = self.contents[i]
-        pieces = [x for x in line.split() if (x.find(':') == -1)]
-        # try:
-        #     pieces = map(float, pieces)
-        # except Exception:
-        #     pass
-        action = pieces[0]
-
-        if len(pieces) == 4:
-            # case 1: T: <action> : <start-state> : <next-state> %f
-            start_state, next_state = pieces[1], pieces[2]
-            self.T[(action, start_state, next_state)] = float(pieces[3])
-            return i + 1
-        elif len(pieces) == 3:
-            # case 2: T: <action> : <start-state> : <next-state>
-            # %f
-            start_state, next_state = pieces[1], pieces[2]
-            self.T[(action, start_state, next_state)] = float(self.contents[i+1])
-            return i + 2
-        elif len(pieces) == 2:
-            # case 3: T: <action> : <start-state>
-            # %f %f ... %f
-            start_state = pieces[1]
-            next_line = self.contents[i+1]
-            probs = next_line.split()
-            assert len(probs) == len(self.states)
-            for j, prob in enumerate(probs):
-                self.T[(action, start_state, j)] = float(prob)
-            return i + 2
-        elif len(pieces) == 1:
-            next_line = self.contents[i+1]
-            if next_line == "identity":
-                # case 4: T: <action>
-                # identity
-                # map(lambda tprob: self.T[tprob] = 1.0 if tprob[1] == tprob[2] else 0.0, [])
-                for comb in itertools.product([action], self.states, self.states):
-                    self.T[(action, comb[1], comb[2])] = 1.0 if comb[1] == comb[2] else 0.0
-                return i + 2
-            elif next_line == "uniform":
-                # case 5: T: <action>
-                # uniform
-                prob = 1.0 / float(len(self.states))
-                for comb in itertools.product([action], self.states, self.states):
-                    self.T[comb] = prob
-                return i + 2
-            else:
-                # case 6: T: <action>
-                # %f %f ... %f
-                # %f %f ... %f
-                # ...
-                # %f %f ... %f
-                for j, sj in enumerate(self.states):
-                    probs = next_line.split()
-                    assert len(probs) == len(self.states)
-                    for k, sk in enumerate(self.states):
-                        prob = float(probs[k])
-                        self.T[(action, sj, sk)] = prob
-                    next_line = self.contents[i+2+j]
-                return i+1+len(self.states)
+            self.start = list(map(float, items))
+
+    def __get_entry__(self, tokens, attr):
+        """
+        Reads '<attr>: <name> [: <name> ...]' and returns the names, the values follow
+        """
+        tokens.expect(attr)
+        tokens.expect(':')
+        names = [tokens.next()]
+        while tokens.peek() == ':':
+            tokens.next()
+            names.append(tokens.next())
+
+        if self.builder is None:
+            builder_cls = SparseBuilder if self.sparse else DenseBuilder
+            self.builder = builder_cls(len(self.states), len(self.actions), len(self.observations))
+            self.s_idx = {s: i for i, s in enumerate(self.states)}
+            self.a_idx = {a: i for i, a in enumerate(self.actions)}
+            self.o_idx = {o: i for i, o in enumerate(self.observations)}
+        return names
+
+    def __get_probs__(self, tokens, table, attr):
+        """
+        Shared by T (columns are next states) and O (columns are observations)
+        """
+        names = self.__get_entry__(tokens, attr)
+        col_idx = self.s_idx if table == 'T' else self.o_idx
+        a, rows = index_of(self.a_idx, names[0]), slice(None)
+        n_rows, n_cols = len(self.states), len(col_idx)
+
+        if len(names) == 3:
+            # case 1: <attr>: <action> : <state> : <col> %f
+            self.builder.set(table, a, index_of(self.s_idx, names[1]), index_of(col_idx, names[2]), float(tokens.next()))
+            return
+
+        if len(names) == 2:
+            # case 2: <attr>: <action> : <state>
+            # %f %f ... %f  |  uniform
+            rows, n_rows = index_of(self.s_idx, names[1]), 1
+        elif len(names) != 1:
+            raise Exception('Cannot parse {} entry: {}'.format(attr, ' : '.join(names)))
+
+        if tokens.peek() == 'uniform':
+            tokens.next()
+            self.builder.set(table, a, rows, slice(None), 1.0 / n_cols)
+        elif tokens.peek() == 'identity' and len(names) == 1:
+            # identity matches states and columns by name
+            tokens.next()
+            cols = array([col_idx.get(s, -1) for s in self.states])
+            self.builder.set_identity(table, a, cols)
         else:
-            raise Exception("Cannot parse line " + line)
-
-    def __get_O(self, i):
-        line = self.contents[i]
-        pieces = [x for x in line.split() if (x.find(':') == -1)]
-        # try:
-        #     pieces = map(float, pieces)
-        # except Exception:
-        #     pass
-        action = pieces[0]
-
-        if len(pieces) == 4:
-            # case 1: O: <action> : <next-state> : <obs> %f
-            next_state, obs, prob = pieces[1], pieces[2], float(pieces[3])
-            self.Z[(action, next_state, obs)] = float(prob)
-            return i + 1
-        elif len(pieces) == 3:
-            # case 2: O: <action> : <next-state> : <obs>
-            # %f
-            next_state, obs = pieces[1], pieces[2]
-            next_line = self.contents[i+1]
-            self.Z[(action, next_state, obs)] = float(next_line)
-            return i + 2
-        elif len(pieces) == 2:
-            # case 3: O: <action> : <next-state>
-            # %f %f ... %f
-            next_state = pieces[1]
-            next_line = self.contents[i+1]
-            probs = next_line.split()
-            assert len(probs) == len(self.observations)
-            for j, obs in enumerate(self.observations):
-                self.Z[(action, next_state, obs)] = float(probs[j])
-            return i + 2
-        elif len(pieces) == 1:
-            next_line = self.contents[i+1]
-            if next_line == "identity":
-                # case 4: O: <action>
-                # identity
-                for comb in itertools.product([action], self.states, self.observations):
-                    self.Z[comb] = 1.0 if comb[1] == comb[2] else 0.0
-                return i + 2
-            elif next_line == "uniform":
-                # case 5: O: <action>
-                # uniform
-                prob = 1.0 / float(len(self.observations))
-                for comb in itertools.product([action], self.states, self.observations):
-                    self.Z[comb] = prob
-                return i + 2
-            else:
-                # case 6: O: <action>
-                # %f %f ... %f
-                # %f %f ... %f
-                # ...
-                # %f %f ... %f
-                for j, sj in enumerate(self.states):
-                    probs = next_line.split()
-                    assert len(probs) == len(self.observations)
-                    for k, oj in enumerate(self.observations):
-                        self.Z[(action, sj, oj)] = prob = float(probs[k])
-                    next_line = self.contents[i + 2 + j]
-                return i + 1 + len(self.states)
-        else:
-            raise Exception("Cannot parse line: " + line)
-
-    def __get_R(self, i):
-        '''
-        Wild card * are allowed when specifying a single reward
-        probability. They are not allowed when specifying a vector or
-        matrix of probabilities.
-        '''
-        line = self.contents[i]
-        pieces = [x for x in line.split() if (x.find(':') == -1)]
-        # try:
-        #     pieces = map(float, pieces)
-        # except Exception:
-        #     pass
-        action = pieces[0]
-
-        if len(pieces) == 5 or len(pieces) == 4:
-            # case 1:
-            # R: <action> : <start-state> : <next-state> : <obs> %f
-            # any of <start-state>, <next-state>, and <obs> can be *
-            # %f can be on the next line (case where len(pieces) == 4)
-            # start_state_raw = pieces[1]
-            # next_state_raw = pieces[2]
-            # obs_raw = pieces[3]
-            start_state, next_state, obs = pieces[1], pieces[2], pieces[3]
-            prob = float(pieces[4]) if len(pieces) == 5 else float(self.contents[i+1])
-
-            # self.__reward_ss(
-            #     action, start_state_raw, next_state_raw, obs_raw, prob)
-
-            self.R[(action, start_state, next_state, obs)] = prob
-            return i + 1 if len(pieces) == 5 else i + 2
-        elif len(pieces) == 3:
-            # case 2: R: <action> : <start-state> : <next-state>
-            # %f %f ... %f
-            start_state, next_state = pieces[1], pieces[2]
-            next_line = self.contents[i+1]
-            probs = next_line.split()
-            assert len(probs) == len(self.observations)
-            for j, obs in enumerate(self.observations):
-                self.R[(action, start_state, next_state, obs)] = float(probs[j])
-            return i + 2
-        elif len(pieces) == 2:
-            # case 3: R: <action> : <start-state>
-            # %f %f ... %f
+            # case 3: <attr>: <action>
             # %f %f ... %f
             # ...
             # %f %f ... %f
-            start_state = pieces[1]
-            next_line = self.contents[i+1]
-            for j, sj in enumerate(self.states):
-                probs = next_line.split()
-                assert len(probs) == len(self.observations)
-                for k, oj in enumerate(self.observations):
-                    prob = float(probs[k])
-                    self.R[(action, start_state, sj, oj)] = prob
-                next_line = self.contents[i + 2 + j]
-            return i + 1 + len(self.states)
-        else:
-            raise Exception("Cannot parse line: " + line)
+            probs = tokens.numbers(n_rows * n_cols)
+            self.builder.set(table, a, rows, slice(None), probs.reshape(n_rows, n_cols) if len(names) == 1 else probs)
 
-    def __reward_ss(self, a, start_state_raw, next_state_raw, obs_raw, prob):
-        '''
-        reward_ss means we're at the start state of the unrolling of the
-        reward expression. start_state_raw could be * or the name of the
-        real start state.
-        '''
-        if start_state_raw == '*':
-            for i in range(len(self.states)):
-                self.__reward_ns(a, i, next_state_raw, obs_raw, prob)
-        else:
-            start_state = self.states.index(start_state_raw)
-            self.__reward_ns(a, start_state, next_state_raw, obs_raw, prob)
+    def __get_T(self, tokens):
+        self.__get_probs__(tokens, 'T', 'T')
 
-    def __reward_ns(self, a, start_state, next_state_raw, obs_raw, prob):
-        '''
-        reward_ns means we're at the next state of the unrolling of the
-        reward expression. start_state is the number of the real start
-        state, and next_state_raw could be * or the name of the real
-        next state.
-        '''
-        if next_state_raw == '*':
-            for i in range(len(self.states)):
-                self.__reward_ob(a, start_state, i, obs_raw, prob)
-        else:
-            next_state = self.states.index(next_state_raw)
-            self.__reward_ob(a, start_state, next_state, obs_raw, prob)
+    def __get_O(self, tokens):
+        self.__get_probs__(tokens, 'Z', 'O')
 
-    def __reward_ob(self, a, start_state, next_state, obs_raw, prob):
+    def __get_R(self, tokens):
         '''
-        reward_ob means we're at the observation of the unrolling of the
-        reward expression. start_state is the number of the real start
-        state, next_state is the number of the real next state, and
-        obs_raw could be * or the name of the real observation.
+        R: <action> : <start-state> : <next-state> : <obs> %f
+        R: <action> : <start-state> : <next-state>
+        %f %f ... %f
+        R: <action> : <start-state>
+        %f %f ... %f
+        ...
+        %f %f ... %f
+        Wild card * are allowed for every name.
         '''
-        if obs_raw == '*':
-            for i in range(len(self.observations)):
-                self.R[(a, start_state, next_state, i)] = prob
+        names = self.__get_entry__(tokens, 'R')
+        if len(names) < 2 or len(names) > 4:
+            raise Exception('Cannot parse R entry: ' + ' : '.join(names))
+        a, si = index_of(self.a_idx, names[0]), index_of(self.s_idx, names[1])
+        n_s, n_o = len(self.states), len(self.observations)
+
+        if len(names) == 4:
+            self.builder.set_reward(a, si, index_of(self.s_idx, names[2]), index_of(self.o_idx, names[3]),
+                                    float(tokens.next()))
+        elif len(names) == 3:
+            self.builder.set_reward(a, si, index_of(self.s_idx, names[2]), slice(None), tokens.numbers(n_o))
         else:
-            obs = self.observations.index(obs_raw)
-            self.R[(a, start_state, next_state, obs)] = prob
+            self.builder.set_reward(a, si, slice(None), slice(None), tokens.numbers(n_s * n_o).reshape(n_s, n_o))
 
     def copy_env(self):
+        """
+        The compiled dynamics are shared rather than copied, models never modify them
+        """
         return {
             "model_name": self.model_name,
             "model_spec": self.model_spec,
             "discount": self.discount,
             "init_state": self.init_state,
-            "values": deepcopy(self.values),
-            "start": deepcopy(self.start),
-            "states": deepcopy(self.states),
-            "costs": deepcopy(self.costs),
-            "actions": deepcopy(self.actions),
-            "observations": deepcopy(self.observations),
-            "T": deepcopy(self.T),
-            "Z": deepcopy(self.Z),
-            "R": deepcopy(self.R)
+            "values": self.values,
+            "start": None if self.start is None else list(self.start),
+            "states": list(self.states),
+            "costs": None if self.costs is None else list(self.costs),
+            "actions": list(self.actions),
+            "observations": list(self.observations),
+            "dynamics": self.dynamics,
         }
 
     def random_beliefs(self):
@@ -361,6 +418,38 @@ class PomdpParser:
         return [1 / n_states for _ in range(n_states)]
 
     def generate_belief_points(self, stepsize):
-        # must be many better ways to do it
-        beliefs = [[random.uniform() for s in self.states] for p in arange(0., 1. + stepsize, stepsize)]
-        return array(beliefs)
+        """
+        :return: one belief drawn uniformly from the simplex for every step of size stepsize in [0, 1]
+        """
+        return random.dirichlet(ones(len(self.states)), size=len(arange(0., 1. + stepsize, stepsize)))
+
+
+class ProceduralEnv:
+    """
+    Stands in for a parser when the environment has no file and the model generates itself from its name,
+    e.g. RockSample-11x11. The model samples its own initial states, so there is no belief vector to supply.
+    """
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.model_name, self.model_spec = PomdpParser.split_model_name(config_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ctx_type, ctx_value, ctx_traceback):
+        self = None
+
+    def copy_env(self):
+        return {
+            "model_name": self.model_name,
+            "model_spec": self.model_spec,
+        }
+
+    def random_beliefs(self):
+        return None
+
+    def generate_beliefs(self):
+        return None
+
+    def generate_belief_points(self, stepsize):
+        raise ValueError('PBVI needs the flat tables of a .POMDP model')
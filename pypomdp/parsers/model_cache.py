@@ -0,0 +1,106 @@
+"""
+Binary cache of compiled .POMDP models.
+
+A parsed model (names, scalars and the compiled dynamics arrays, see models.dynamics) is stored as an
+uncompressed .npz file named after the source file and the hash of its content, so a cached model is used
+as long as the source file is unchanged and loading it involves no text parsing at all. Saving a model
+removes the entries cached for previous contents of the same file.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import numpy as np
+
+from models.dynamics import DenseDynamics, SparseDynamics
+
+FORMAT_VERSION = 1
+SCALARS = ('discount', 'values', 'init_state')
+NAME_LISTS = ('states', 'actions', 'observations')
+ENTRY = re.compile(r'^(?P<source>.+)\.(?P<hash>[0-9a-f]{40})-(dense|sparse)-v(?P<version>\d+)\.npz$')
+
+
+def content_hash(config_file):
+    digest = hashlib.sha1()
+    with open(config_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_file(cache_dir, config_file, sparse):
+    """
+    :return: path of the cached model for the current content of config_file
+    """
+    key = '{}-{}-v{}'.format(content_hash(config_file), 'sparse' if sparse else 'dense', FORMAT_VERSION)
+    return os.path.join(cache_dir, '{}.{}.npz'.format(os.path.basename(config_file), key))
+
+
+def save(path, env):
+    """
+    Stores the env of a PomdpParser (see PomdpParser.copy_env). The file is written under a temporary
+    name and then moved in place, so concurrent runs never see a partial file.
+    :param path: as given by cache_file
+    """
+    arrays = {'dynamics.' + k: v for k, v in env['dynamics'].to_arrays().items()}
+    arrays['sparse'] = np.array(isinstance(env['dynamics'], SparseDynamics))
+    for attr in NAME_LISTS:
+        arrays[attr] = np.array(env[attr], dtype=str)
+    for attr in SCALARS:
+        if env[attr] is not None:
+            arrays[attr] = np.array(env[attr])
+    if env['start'] is not None:
+        arrays['start'] = np.asarray(env['start'], dtype=np.float64)
+    if env['costs'] is not None:
+        arrays['costs'] = np.asarray(env['costs'], dtype=np.float64)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    evict(path)
+
+
+def evict(path):
+    """
+    Removes the entries cached for the same source file with another content hash or format version,
+    the dense and sparse entries of the current content are kept
+    :param path: as given by cache_file
+    """
+    folder, current = os.path.split(path)
+    current = ENTRY.match(current)
+    for fname in os.listdir(folder or '.'):
+        entry = ENTRY.match(fname)
+        if entry is None or entry.group('source') != current.group('source'):
+            continue
+        if (entry.group('hash'), entry.group('version')) != (current.group('hash'), current.group('version')):
+            try:
+                os.remove(os.path.join(folder, fname))
+            except FileNotFoundError:
+                pass    # evicted by a concurrent run
+
+
+def load(path):
+    """
+    :return: the env fields stored by save, without model_name and model_spec
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        arrays = {k: npz[k] for k in npz.files}
+
+    dynamics_cls = SparseDynamics if arrays['sparse'] else DenseDynamics
+    env = {
+        'dynamics': dynamics_cls.from_arrays({k[len('dynamics.'):]: v for k, v in arrays.items()
+                                              if k.startswith('dynamics.')}),
+        'start': arrays['start'].tolist() if 'start' in arrays else None,
+        'costs': arrays['costs'].tolist() if 'costs' in arrays else None,
+    }
+    for attr in NAME_LISTS:
+        env[attr] = arrays[attr].tolist()
+    for attr in SCALARS:
+        env[attr] = arrays[attr].item() if attr in arrays else None
+    return env
@@ -1,11 +1,16 @@
 import os
 
-from models import RockSampleModel, Model
+from models import RockSampleModel, Model, FactoredModel
 from solvers import POMCP, PBVI
-from parsers import PomdpParser, GraphViz
+from parsers import PomdpParser, PomdpxParser, ProceduralEnv, GraphViz
+from util import SparseBelief
 from logger import Logger as log
 
 class PomdpRunner:
+    # models that generate themselves from their name when there is no environment file, e.g. RockSample-11x11
+    PROCEDURAL_MODELS = {
+        'RockSample': RockSampleModel,
+    }
 
     def __init__(self, params):
         self.params = params
@@ -18,10 +23,14 @@ class PomdpRunner:
         :param env_configs: the complete encapsulation of environment's dynamics
         :return: concrete model
         """
-        MODELS = {
-            'RockSample': RockSampleModel,
-        }
-        return MODELS.get(env_configs['model_name'], Model)(env_configs)
+        if 'state_variables' in env_configs:
+            # factored models parsed from .pomdpx files
+            return FactoredModel(env_configs)
+
+        if 'states' not in env_configs:
+            # no environment file was parsed, see ProceduralEnv
+            return self.PROCEDURAL_MODELS[env_configs['model_name']](env_configs)
+        return Model(env_configs, sparse=self.params.sparse)
 
     def create_solver(self, algo, model):
         """
@@ -40,23 +49,51 @@ class PomdpRunner:
         visualiser.update(tree.root)
         visualiser.render('./dev/snapshots/{}'.format(filename))  # TODO: parametrise the dev folder path
 
+    def load_or_solve(self, pomdp, policy, T):
+        """
+        Reuses the PBVI policy saved in the policy folder for this model, otherwise solves and saves it there
+        """
+        if pomdp.load_policy(policy):
+            log.info('Loaded policy from {}, skipping solve'.format(policy))
+            return
+        pomdp.solve(T)
+        pomdp.save_policy(policy)
+        log.info('Saved policy to {}'.format(policy))
+
     def run(self, algo, T, **kwargs):
         visualiser = GraphViz(description='tmp')
         params, pomdp = self.params, None
         total_rewards, budget = 0, params.budget
 
         log.info('~~~ initialising ~~~')
-        with PomdpParser(params.env_config) as ctx:
+        if params.env.endswith('.pomdpx'):
+            parser = PomdpxParser(params.env_config)
+        elif not os.path.exists(params.env_config):
+            # no file, the model generates itself from its name, e.g. RockSample-11x11
+            if PomdpParser.split_model_name(params.env_config)[0] not in self.PROCEDURAL_MODELS:
+                raise FileNotFoundError('No environment file {}'.format(params.env_config))
+            parser = ProceduralEnv(params.env_config)
+        else:
+            parser = PomdpParser(params.env_config, sparse=params.sparse, cache_dir=params.cache_folder)
+
+        with parser as ctx:
             # creates model and solver
             model = self.create_model(ctx.copy_env())
             pomdp = self.create_solver(algo, model)
 
             # supply additional algo params
             belief = ctx.random_beliefs() if params.random_prior else ctx.generate_beliefs()
+            if params.sparse and belief is not None:
+                # tracks the belief by its support only
+                belief = SparseBelief.from_dense(belief)
 
             if algo == 'pbvi':
-                belief_points = ctx.generate_belief_points(kwargs['stepsize'])
-                pomdp.add_configs(belief_points)
+                # random belief points are only added to the reachable ones when a stepsize is configured
+                stepsize = kwargs.pop('stepsize', None)
+                belief_points = ctx.generate_belief_points(stepsize) if stepsize else None
+                pomdp.add_configs(belief, belief_points, **kwargs)
+                if params.policy is not None:
+                    self.load_or_solve(pomdp, params.policy, T)
             elif algo == 'pomcp':
                 pomdp.add_configs(budget, belief, **kwargs)
 
@@ -1,32 +1,99 @@
+import os
+import time
 import numpy as np
 
 from solvers import Solver
+from logger import Logger as log
+from util import alpha_vector
 from util.alpha_vector import AlphaVector
-from array import array
-
-MIN = -np.inf
+from util.sparse_belief import SparseBelief
+from util.shared_arrays import SharedArrays
 
 
 class PBVI(Solver):
+    EXPANSIONS = ('ssra', 'ssea', 'ger')
+
     def __init__(self, model):
         Solver.__init__(self, model)
         self.belief_points = None
-        self.alpha_vecs = None
+        self.alphas = None              # |Gamma| x |S| matrix, one alpha vector per row
+        self.alpha_actions = None       # index of the action of every alpha vector, -1 for the initial one
         self.solved = False
 
-    def add_configs(self, belief_points):
+        self.expansion = None           # how the belief set grows between backups, one of EXPANSIONS or None
+        self.max_belief_points = None   # the belief set stops growing at this size, np.inf for no limit
+        self.expansion_interval = None  # number of backups between two expansions
+        self.tolerance = 1e-6           # successors closer than this (L1) to a belief point are not added
+        self.prune = True               # removes duplicate and dominated alpha vectors after each backup
+        self.lp_prune = False           # also removes the vectors dominated by combinations of others (needs scipy)
+        self.epsilon = None             # solving stops once the Bellman residual over the belief set is below
+        self.time_budget = None         # solving stops after this many seconds
+        self.iteration = 0              # number of backups performed so far
+        self.history = []               # (iteration, seconds, residual, alpha vectors, belief points) per backup
+
+    def add_configs(self, initial_belief, belief_points=None, expansion='ssea', max_belief_points=100,
+                    expansion_interval=1, prune=True, lp_prune=False, epsilon=None, time_budget=None):
+        """
+        :param initial_belief: the belief set starts from the initial belief and the given belief points
+        :param expansion: grows the belief set with beliefs reachable from it, interleaved with the backups:
+            'ssra' stochastic simulation with a random action,
+            'ssea' stochastic simulation with explorative action (keeps the successor farthest from the set),
+            'ger' greedy error reduction (keeps the successor with the largest expected error bound),
+            None to back up at the given belief points only
+        :param max_belief_points: the belief set stops growing at this size, None for no limit
+        :param prune: removes duplicate and pointwise dominated alpha vectors after each backup
+        :param lp_prune: additionally runs a linear program per vector to remove the ones that are not the best
+            anywhere in the belief simplex, requires scipy
+        :param epsilon: solve stops early once the largest change of the value of any belief point during a
+            backup (the Bellman residual) is below epsilon and the belief set has stopped growing
+        :param time_budget: solve stops early after this many seconds
+        """
         Solver.add_configs(self)
-        self.alpha_vecs = [AlphaVector(a=-1, v=np.zeros(self.model.num_states))] # filled with a dummy alpha vector
-        self.belief_points = belief_points
+        if getattr(self.model, 'dynamics', None) is None:
+            raise ValueError('PBVI needs the tabular dynamics of a .POMDP model')
+        if expansion is not None and expansion not in self.EXPANSIONS:
+            raise ValueError('Unknown belief expansion {}, expected one of {}'.format(expansion, self.EXPANSIONS))
+        if lp_prune and alpha_vector.linprog is None:
+            raise ImportError('lp_prune requires scipy')
+
+        # starts from a dummy alpha vector that is a lower bound of the value function, min R / (1 - discount)
+        # everywhere, so that backups only ever raise the values and converge monotonically
+        lower_bound = self.model.dynamics.R.min() / (1 - self.model.discount)
+        self.alphas = np.full((1, self.model.num_states), lower_bound)
+        self.alpha_actions = np.array([-1])
+        self.expansion = expansion
+        self.max_belief_points = np.inf if max_belief_points is None else max_belief_points
+        self.expansion_interval = expansion_interval
+        self.prune, self.lp_prune = prune, lp_prune
+        self.epsilon, self.time_budget = epsilon, time_budget
+        self.iteration, self.history = 0, []
+
+        self.belief_points = np.asarray(initial_belief, dtype=float)[None, :]
+        if belief_points is not None:
+            self.belief_points = self.add_belief_points(np.asarray(belief_points, dtype=float))
         self.compute_gamma_reward()
 
+    @property
+    def alpha_vecs(self):
+        """
+        The value function as a list of AlphaVector, copies of the rows of alphas
+        """
+        return [AlphaVector(a=self.model.actions[a] if a >= 0 else -1, v=v.copy())
+                for a, v in zip(self.alpha_actions, self.alphas)]
+
+    @alpha_vecs.setter
+    def alpha_vecs(self, alpha_vecs):
+        self.alphas = np.array([alpha.v for alpha in alpha_vecs], dtype=float)
+        self.alpha_actions = np.array([self.model.action_idx[alpha.action] if alpha.action != -1 else -1
+                                       for alpha in alpha_vecs], dtype=np.int64)
+
     def compute_gamma_reward(self):
         """
         :return: Action_a => Reward(s,a) matrix
         """
-
+        R = self.model.dynamics.R
         self.gamma_reward = {
-            a: np.frombuffer(array('d', [self.model.reward_function(a, s) for s in self.model.states]))
+            a: R[self.model.action_idx[a]].copy()
             for a in self.model.actions
         }
 
@@ -36,94 +103,354 @@ class PBVI(Solver):
         vector that represents the update to that alpha vector
         given an action and observation
 
+        :param a: action name
+        :param o: observation name
+        :return: |Gamma| x |S| matrix
+        """
+        m = self.model
+        return m.discount * m.dynamics.backproject(m.action_idx[a], m.obs_idx[o], self.alphas)
+
+    def backup(self):
+        """
+        Performs one point-based backup of the alpha vectors over all belief points,
+        every step is a batched matrix operation over the stacked alpha vectors and belief points
+        :return: the new alpha vectors and their action indices, one per belief point
+        """
+        m = self.model
+        alphas = self.alphas                                         # |Gamma| x |S|
+        beliefs = np.asarray(self.belief_points)                     # |B| x |S|
+        n_beliefs, n_obs = len(beliefs), m.num_observations
+        obs_range = np.arange(n_obs)[:, None]
+
+        # Action(a) => |B| x |S| matrix of the best cross-summed vector for each belief point
+        gamma_action_belief = np.empty((m.num_actions, n_beliefs, m.num_states))
+        for a, action in enumerate(m.actions):
+            # Gamma^{a,o} for every observation: |O| x |Gamma| x |S|
+            gamma_action_obs = m.discount * m.dynamics.backproject_all(a, alphas)
+
+            # for every (o, b) only consider the projected vector maximising the value at b: |O| x |B|
+            best_alpha_idx = np.argmax(gamma_action_obs.dot(beliefs.T), axis=1)
+
+            # cross sum over observations
+            gamma_action_belief[a] = self.gamma_reward[action] + \
+                gamma_action_obs[obs_range, best_alpha_idx].sum(axis=0)
+
+        # Finally pick the best action for each belief point: |A| x |B|
+        # actions leading nowhere from a belief (empty transition rows) are not taken there
+        values = np.einsum('abs,bs->ab', gamma_action_belief, beliefs)
+        defined = np.array([m.dynamics.propagate(a, beliefs).sum(axis=1) > 0 for a in range(m.num_actions)])
+        values[~defined] = -np.inf
+        best_actions = np.argmax(values, axis=0)
+        best_vectors = gamma_action_belief[best_actions, np.arange(n_beliefs)]
+
+        # a point keeps its previous vector where the backup did worse (as in Perseus), so the values never decrease
+        old_values = beliefs.dot(alphas.T)
+        old_best = np.argmax(old_values, axis=1)
+        improved = values[best_actions, np.arange(n_beliefs)] >= old_values[np.arange(n_beliefs), old_best]
+
+        best_vectors[~improved] = alphas[old_best[~improved]]
+        return best_vectors, np.where(improved, best_actions, self.alpha_actions[old_best])
+
+    def prune_alpha_vecs(self):
+        """
+        Removes duplicate and dominated alpha vectors, see util.alpha_vector.prune
+        :return: the number of vectors removed
+        """
+        n = len(self.alphas)
+        keep = alpha_vector.prune(self.alphas, lp=self.lp_prune)
+        self.alphas, self.alpha_actions = self.alphas[keep], self.alpha_actions[keep]
+        return n - len(keep)
+
+    def successors(self, beliefs, a):
+        """
+        :param beliefs: |B| x |S| matrix
         :param a: action index
-        :param o: observation index
+        :return: |O| x |B| x |S| successor beliefs tau(b, a, o) and the |O| x |B| probabilities P(o | b, a).
+        Successors of impossible observations are left at zero.
         """
         m = self.model
+        predicted = m.dynamics.propagate(a, beliefs)
+        joint = np.array([predicted * m.dynamics.observation_likelihood(a, o) for o in range(m.num_observations)])
+        probs = joint.sum(axis=2)
+        return joint / np.where(probs > 0, probs, 1.0)[:, :, None], probs
+
+    def distances(self, beliefs):
+        """
+        :return: L1 distance of every belief to its nearest belief point, and the index of that point
+        """
+        dist, nearest = np.full(len(beliefs), np.inf), np.zeros(len(beliefs), dtype=int)
+        rows = np.arange(len(beliefs))
+        # compares the beliefs with blocks of belief points, keeping the |B| x block x |S| differences small
+        block = max(1, (1 << 22) // max(1, beliefs.size))
+        for i in range(0, len(self.belief_points), block):
+            d = np.abs(beliefs[:, None, :] - self.belief_points[None, i:i + block, :]).sum(axis=2)
+            j = d.argmin(axis=1)
+            closer = d[rows, j] < dist
+            dist[closer], nearest[closer] = d[rows, j][closer], i + j[closer]
+        return dist, nearest
 
-        gamma_action_obs = []
-        for alpha in self.alpha_vecs:
-            v = np.zeros(m.num_states)  # initialize the update vector [0, ... 0]
-            for i, si in enumerate(m.states):
-                for j, sj in enumerate(m.states):
-                    v[i] += m.transition_function(a, si, sj) * \
-                        m.observation_function(a, sj, o) * \
-                        alpha.v[j]
-                v[i] *= m.discount
-            gamma_action_obs.append(v)
-        return gamma_action_obs
+    def error_bounds(self, beliefs):
+        """
+        Upper bound on the value error at each belief when evaluated by the alpha vector of its nearest belief
+        point b (Pineau et al., 2006): sum over s of (b'(s) - b(s)) times Rmax / (1 - discount) - alpha(s)
+        where b'(s) >= b(s), Rmin / (1 - discount) - alpha(s) elsewhere
+        """
+        m = self.model
+        _, nearest = self.distances(beliefs)
+        points = self.belief_points[nearest]
+        alphas = self.alphas[self.best_alphas(points)]
 
-    def solve(self, T):
-        if self.solved:
-            return
+        diff = beliefs - points
+        bound = np.where(diff >= 0, m.dynamics.R.max(), m.dynamics.R.min()) / (1 - m.discount)
+        return (diff * (bound - alphas)).sum(axis=1)
 
+    def expand(self, deadline=None):
+        """
+        Proposes one reachable successor for every belief point and adds the best scoring ones that are new,
+        until max_belief_points is reached
+        :param deadline: time.time() after which the expansion stops with what it has proposed so far
+        :return: the number of belief points added
+        """
         m = self.model
-        for step in range(T):
+        beliefs = self.belief_points
+        n = len(beliefs)
+        rows = np.arange(n)
 
-            # First compute a set of updated vectors for every action/observation pair
-            # Action(a) => Observation(o) => UpdateOfAlphaVector (a, o)
-            gamma_intermediate = {
-                a: {
-                    o: self.compute_gamma_action_obs(a, o)
-                    for o in m.observations
-                } for a in m.actions
-            }
+        def sample_successor(succ, probs):
+            # draws an observation for every belief point, as a simulation starting from the belief would
+            cumulative = np.cumsum(probs, axis=0)
+            u = np.random.random(n) * cumulative[-1]
+            o = np.minimum((cumulative <= u).sum(axis=0), len(probs) - 1)
+            return succ[o, rows]
 
-            # Now compute the cross sum
-            gamma_action_belief = {}
-            for a in m.actions:
+        if self.expansion == 'ssra':
+            candidates = np.zeros_like(beliefs)
+            actions = np.random.randint(m.num_actions, size=n)
+            for a in np.unique(actions):
+                if deadline is not None and time.time() >= deadline:
+                    break
+                succ, probs = self.successors(beliefs, a)
+                candidates[actions == a] = sample_successor(succ, probs)[actions == a]
+            scores = np.random.random(n)
+        elif self.expansion == 'ssea':
+            candidates, scores = np.zeros_like(beliefs), np.full(n, -np.inf)
+            for a in range(m.num_actions):
+                if deadline is not None and time.time() >= deadline:
+                    break
+                succ, probs = self.successors(beliefs, a)
+                succ = sample_successor(succ, probs)
+                dist, _ = self.distances(succ)
+                better = (dist > scores) & (probs.sum(axis=0) > 0)
+                candidates[better], scores[better] = succ[better], dist[better]
+        else:
+            candidates, scores = np.zeros_like(beliefs), np.full(n, -np.inf)
+            for a in range(m.num_actions):
+                if deadline is not None and time.time() >= deadline:
+                    break
+                succ, probs = self.successors(beliefs, a)
+                errors = self.error_bounds(succ.reshape(-1, m.num_states)).reshape(probs.shape) * probs
+                expected = errors.sum(axis=0)
+                better = (expected > scores) & (probs.sum(axis=0) > 0)
+                o = errors.argmax(axis=0)
+                candidates[better], scores[better] = succ[o, rows][better], expected[better]
 
-                gamma_action_belief[a] = {}
-                for bidx, b in enumerate(self.belief_points):
+        # actions without any outcome from a belief leave no successor behind
+        candidates = candidates[np.argsort(-scores, kind='stable')]
+        n_points = len(self.belief_points)
+        self.belief_points = self.add_belief_points(candidates[candidates.sum(axis=1) > 0.5], deadline)
+        return len(self.belief_points) - n_points
 
-                    gamma_action_belief[a][bidx] = self.gamma_reward[a].copy()
+    def add_belief_points(self, candidates, deadline=None):
+        """
+        :param candidates: beliefs in order of preference
+        :param deadline: time.time() after which no more candidates are considered
+        :return: the belief points extended by the candidates that are not already in the set,
+        without going beyond max_belief_points
+        """
+        n = len(self.belief_points)
+        room = int(min(self.max_belief_points - n, len(candidates)))
+        if room <= 0:
+            return self.belief_points
 
-                    for o in m.observations:
-                        # only consider the best point
-                        best_alpha_idx = np.argmax(np.dot(gamma_intermediate[a][o], b))
-                        gamma_action_belief[a][bidx] += gamma_intermediate[a][o][best_alpha_idx]
+        # beliefs closer than tolerance (L1) have projections closer than tolerance on any vector within
+        # [-1, 1]^S, so only the few points whose projection falls within tolerance of a candidate's are compared
+        points = np.empty((n + room, candidates.shape[1]))
+        points[:n] = self.belief_points
+        w = np.random.RandomState(0).uniform(-1, 1, candidates.shape[1])
+        keys = np.concatenate([points[:n].dot(w), candidates.dot(w)])
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        row = np.full(len(keys), -1)    # row of points holding every belief point and accepted candidate
+        row[:n] = np.arange(n)
 
-            # Finally compute the new(best) alpha vector set
-            self.alpha_vecs, max_val = [], MIN
+        k = n
+        for i, b in enumerate(candidates):
+            if k == n + room or (deadline is not None and time.time() >= deadline):
+                break
+            lo, hi = np.searchsorted(sorted_keys, [keys[n + i] - self.tolerance, keys[n + i] + self.tolerance])
+            near = row[order[lo:hi]]
+            near = near[near >= 0]
+            if len(near) == 0 or np.abs(points[near] - b).sum(axis=1).min() > self.tolerance:
+                points[k], row[n + i] = b, k
+                k += 1
+        return points[:k]
+
+    def best_alphas(self, beliefs):
+        """
+        :param beliefs: |B| x |S| matrix
+        :return: the row of alphas maximising the value of every belief
+        """
+        return np.argmax(np.asarray(beliefs).dot(self.alphas.T), axis=1)
 
-            for bidx, b in enumerate(self.belief_points):
-                best_av, best_aa = None, None
+    def values(self, beliefs):
+        """
+        :param beliefs: |B| x |S| matrix
+        :return: the value of every belief, a single matrix product with the alpha vectors
+        """
+        return np.asarray(beliefs).dot(self.alphas.T).max(axis=1)
 
-                for a in m.actions:
-                    val = np.dot(gamma_action_belief[a][bidx], b)
-                    if best_av is None or val > max_val:
-                        max_val = val
-                        best_av = gamma_action_belief[a][bidx].copy()
-                        best_aa = a
+    def get_actions(self, beliefs):
+        """
+        Batched get_action
+        :param beliefs: |B| x |S| matrix
+        :return: the name of the best action for every belief
+        """
+        actions = self.alpha_actions[self.best_alphas(beliefs)]
+        return [self.model.actions[a] if a >= 0 else -1 for a in actions]
 
-                self.alpha_vecs.append(AlphaVector(a=best_aa, v=best_av))
+    def solve(self, T):
+        """
+        Solves once, see improve
+        """
+        if self.solved:
+            return
 
+        self.improve(T)
         self.solved = True
 
+    def improve(self, T):
+        """
+        Performs up to T more backups starting from the current alpha vectors, so that solving can be resumed.
+        The belief set is expanded every expansion_interval backups, and also as soon as the values converged on
+        the current set. Stops early once converged on a set that cannot grow anymore, or when time_budget runs out.
+        :return: whether the value function converged
+        """
+        start = time.time()
+        for step in range(T):
+            tic = time.time()
+            old_values = self.values(self.belief_points)
+            self.alphas, self.alpha_actions = self.backup()
+            pruned = self.prune_alpha_vecs() if self.prune else 0
+            residual = np.abs(self.values(self.belief_points) - old_values).max()
+            converged = self.epsilon is not None and residual < self.epsilon
+            self.iteration += 1
+
+            added = 0
+            if self.expansion is not None and len(self.belief_points) < self.max_belief_points and \
+                    (converged or (self.iteration % self.expansion_interval == 0 and step < T - 1)):
+                added = self.expand(None if self.time_budget is None else start + self.time_budget)
+
+            elapsed = time.time() - tic
+            self.history.append((self.iteration, elapsed, residual, len(self.alphas), len(self.belief_points)))
+            log.info('PBVI iteration {}: residual {:.6g}, {} alpha vectors ({} pruned), {} belief points ({} new), '
+                     '{:.3f}s'.format(self.iteration, residual, len(self.alphas), pruned,
+                                      len(self.belief_points), added, elapsed))
+
+            if converged and not added:
+                log.info('PBVI converged after {} iterations'.format(self.iteration))
+                return True
+            if self.time_budget is not None and time.time() - start >= self.time_budget:
+                log.info('PBVI time budget of {}s spent'.format(self.time_budget))
+                break
+        return False
+
+    def save_policy(self, folder):
+        """
+        Stores the solved value function as .npy files in folder: the alpha matrix, the action index of every
+        vector and the fingerprint of the model it was solved for
+        """
+        fingerprint = os.path.join(folder, 'fingerprint.npy')
+        if os.path.exists(fingerprint):
+            # a half-overwritten policy must not match, the fingerprint is written last again
+            os.remove(fingerprint)
+        SharedArrays.save(folder, {
+            'alphas': self.alphas,
+            'alpha_actions': self.alpha_actions,
+            'fingerprint': np.array(self.model.fingerprint()),
+        })
+
+    def load_policy(self, folder):
+        """
+        Uses the value function saved in folder, memory-mapped read-only, and considers the model solved
+        :return: False, leaving the solver untouched, when there is no policy saved for this model in folder
+        """
+        if not os.path.exists(os.path.join(folder, 'fingerprint.npy')):
+            return False
+        policy = SharedArrays.open(folder)
+        if str(policy['fingerprint']) != self.model.fingerprint():
+            log.info('Policy in {} was solved for another model, ignored'.format(folder))
+            return False
+
+        self.alphas, self.alpha_actions = policy['alphas'], policy['alpha_actions']
+        self.solved = True
+        return True
+
     def get_action(self, belief):
-        max_v = -np.inf
-        best = None
-        for av in self.alpha_vecs:
-            v = np.dot(av.v, belief)
-            if v > max_v:
-                max_v = v
-                best = av
-
-        return best.action
-    
+        if isinstance(belief, SparseBelief):
+            a = self.alpha_actions[np.argmax(belief.dot(self.alphas))]
+            return self.model.actions[a] if a >= 0 else -1
+        return self.get_actions(np.asarray(belief, dtype=float)[None, :])[0]
+
     def update_belief(self, belief, action, obs):
+        if isinstance(belief, SparseBelief):
+            return self.update_sparse_belief(belief, action, obs)
+        return self.update_beliefs(np.asarray(belief, dtype=float)[None, :], [action], [obs])[0].tolist()
+
+    def update_sparse_belief(self, belief, action, obs):
+        """
+        update_belief for a SparseBelief, the cost only depends on the belief's support and the number of
+        successors of its states (with sparse dynamics)
+        """
         m = self.model
+        a, o = m.action_idx[action], m.obs_idx[obs]
+        states, predicted = m.dynamics.propagate_sparse(a, belief.states, belief.probs)
+        posterior = predicted * m.dynamics.observation_probabilities(a, states, o)
+
+        # same fallbacks as update_beliefs
+        if posterior.sum() <= 0:
+            posterior = predicted
+        if posterior.sum() <= 0:
+            return belief
+        support = posterior > 0
+        return SparseBelief(states[support], posterior[support] / posterior.sum(), belief.n_states)
 
-        b_new = []
-        for sj in m.states:
-            p_o_prime = m.observation_function(action, sj, obs)
-            summation = 0.0
-            for i, si in enumerate(m.states):
-                p_s_prime = m.transition_function(action, si, sj)
-                summation += p_s_prime * float(belief[i])
-            b_new.append(p_o_prime * summation)
+    def update_beliefs(self, beliefs, actions, observations):
+        """
+        Batched belief update, b'(s') proportional to Z(a, s', o) * sum_s b(s) * T(a, s, s') for every row.
+        When the observation is impossible under a belief, the row falls back to the predicted distribution
+        sum_s b(s) * T(a, s, .), and when the action leads nowhere the belief is kept as it is.
+
+        :param beliefs: |B| x |S| matrix
+        :param actions: one action per belief, given by name or index
+        :param observations: one observation per belief, given by name or index
+        :return: |B| x |S| matrix of the updated beliefs
+        """
+        m = self.model
+        beliefs = np.asarray(beliefs, dtype=float)
+        actions = np.array([m.action_idx[a] for a in actions] if len(actions) and isinstance(actions[0], str)
+                           else actions, dtype=np.int64)
+        observations = np.array([m.obs_idx[o] for o in observations] if len(observations) and
+                                isinstance(observations[0], str) else observations, dtype=np.int64)
 
-        # normalize
-        total = sum(b_new)
-        return [x / total for x in b_new]
+        updated = beliefs.copy()
+        for a in np.unique(actions):
+            rows = np.flatnonzero(actions == a)
+            predicted = m.dynamics.propagate(a, beliefs[rows])
+            posterior = predicted * m.dynamics.observation_likelihoods(a, observations[rows])
 
+            total = posterior.sum(axis=1)
+            impossible = total <= 0
+            posterior[impossible], total[impossible] = predicted[impossible], predicted[impossible].sum(axis=1)
+            defined = total > 0
+            updated[rows[defined]] = posterior[defined] / total[defined, None]
+        return updated
@@ -1,35 +1,46 @@
 from solvers import Solver
-from util.helper import rand_choice, randint, round
-from util.helper import elem_distribution, ucb
+from util.helper import rand_choice, randint, systematic_resample
+from util.helper import ucb1_select, sa_ucb_select, mab_bv1_select, seed_jit
 from util.belief_tree import BeliefTree
+from util.particle_set import ParticleSet
+from util.sparse_belief import SparseBelief
+from solvers import pomcp_kernel
 from logger import Logger as log
+import atexit
+import multiprocessing
+import random
 import numpy as np
 import time
 
-MAX = np.inf
-
 class UtilityFunction():
+    """
+    Each algorithm takes the belief tree and a belief node id, scores all action children of the node in one
+    pass over the tree's statistic arrays and returns the id of the best child (ties broken at random)
+    """
     @staticmethod
     def ucb1(c):
-        def algorithm(action):
-            return action.V + c * ucb(action.parent.N, action.N)
+        def algorithm(tree, nid):
+            start = tree.first_child[nid]
+            block = slice(start, start + tree.num_children[nid])
+            return start + ucb1_select(tree.N[nid], tree.N[block], tree.V[block], c)
         return algorithm
     
     @staticmethod
     def mab_bv1(min_cost, c=1.0):
-        def algorithm(action):
-            if action.mean_cost == 0.0:
-                return MAX
-            ucb_value = ucb(action.parent.N, action.N)
-            return action.mean_reward / action.mean_cost + c * ((1. + 1. / min_cost) * ucb_value) / (min_cost - ucb_value)
+        def algorithm(tree, nid):
+            start = tree.first_child[nid]
+            block = slice(start, start + tree.num_children[nid])
+            return start + mab_bv1_select(tree.N[nid], tree.N[block], tree.mean_reward[block],
+                                          tree.mean_cost[block], min_cost, c)
         return algorithm
 
     @staticmethod
     def sa_ucb(c0):
-        def algorithm(action):
-            if action.mean_cost == 0.0:
-                return MAX
-            return action.V + c0 * action.parent.budget * ucb(action.parent.N, action.N)
+        def algorithm(tree, nid):
+            start = tree.first_child[nid]
+            block = slice(start, start + tree.num_children[nid])
+            return start + sa_ucb_select(tree.N[nid], tree.budget[nid], tree.N[block], tree.V[block],
+                                         tree.mean_cost[block], c0)
         return algorithm
 
 
@@ -41,10 +52,21 @@ class POMCP(Solver):
         self.simulation_time = None  # in seconds
         self.max_particles = None    # maximum number of particles can be supplied by hand for a belief node
         self.reinvigorated_particles_ratio = None  # ratio of max_particles to mutate 
+        self.reinvigoration = None   # when to mutate particles: 'deprivation', 'always' or 'never'
+        self.particle_filter = None  # how the new root's particles are found: 'rejection' or 'weighted'
+        self.ess_threshold = None    # weighted filter resamples once ESS drops below this ratio of the particles
+        self.root_weights = None     # importance weights of the root particles, None when they are unweighted
         self.utility_fn = None
+        self.utility_args = None     # (utility function code, C, min cost) for the compiled search
+        self.kernel_model = None     # model arrays for the compiled search, None to use the Python search
+
+        self.workers = 1             # number of processes searching from the root in parallel
+        self.pool = None
+        self.seed_sequence = None
 
     def add_configs(self, budget=float('inf'), initial_belief=None, simulation_time=0.5,
-                    max_particles=350, reinvigorated_particles_ratio=0.1, utility_fn='ucb1', C=0.5):
+                    max_particles=350, reinvigorated_particles_ratio=0.1, utility_fn='ucb1', C=0.5, workers=1,
+                    compiled=True, particle_filter='rejection', ess_threshold=0.5, reinvigoration='deprivation'):
         # acquaire utility function to choose the most desirable action to try
         if utility_fn == 'ucb1':
             self.utility_fn = UtilityFunction.ucb1(C)
@@ -54,80 +76,131 @@ class POMCP(Solver):
             if self.model.costs is None:
                 raise ValueError('Must specify action costs if utility function is MAB_BV1')
             self.utility_fn = UtilityFunction.mab_bv1(min(self.model.costs), C)
+        min_cost = min(self.model.costs) if utility_fn == 'mab_bv1' else 0.0
+        self.utility_args = (pomcp_kernel.UTILITY_FUNCTIONS[utility_fn], float(C), float(min_cost))
+
+        # run the simulations in native code whenever the model's dynamics are plain tables
+        self.kernel_model = None
+        if compiled:
+            if pomcp_kernel.supports(self.model):
+                self.kernel_model = pomcp_kernel.model_arrays(self.model)
+            else:
+                log.info('{} is searched without the compiled kernel'.format(type(self.model).__name__))
 
         # other configs
         self.simulation_time = simulation_time
         self.max_particles = max_particles
         self.reinvigorated_particles_ratio = reinvigorated_particles_ratio
+        self.reinvigoration = reinvigoration
+        self.particle_filter = particle_filter
+        self.ess_threshold = ess_threshold
+        self.root_weights = None
+        if particle_filter == 'weighted' and not hasattr(self.model, 'dynamics'):
+            raise ValueError('The weighted particle filter needs the observation probabilities of the model')
         
         # initialise belief search tree
         root_particles = self.model.gen_particles(n=self.max_particles, prob=initial_belief)
-        self.tree = BeliefTree(budget, root_particles)
+        self.tree = BeliefTree(budget, root_particles, self.model.actions, self.model.observations, max_particles)
+        # compiles the action selection (or loads it from numba's cache) before the first search
+        self.utility_fn(self.tree, self.tree.root_id)
+        if self.kernel_model is not None:
+            self.compile_kernel(T=1)
+
+        # root parallelisation: this process searches its own tree and the other workers search independent
+        # trees from the same root particles, their root statistics are merged before choosing an action
+        self.workers = workers
+        if self.workers > 1:
+            worker_configs = dict(simulation_time=simulation_time, max_particles=max_particles,
+                                  reinvigorated_particles_ratio=reinvigorated_particles_ratio,
+                                  utility_fn=utility_fn, C=C, compiled=compiled)
+            self.seed_sequence = np.random.SeedSequence()
+            if getattr(self.model, 'dynamics', None) is not None and self.model.shared is None:
+                # the workers attach to one shared copy of the model's tensors instead of receiving their own
+                atexit.register(self.model.share().unlink)
+            self.pool = multiprocessing.Pool(self.workers - 1, initializer=init_worker,
+                                             initargs=(self.model, worker_configs))
 
     def compute_belief(self):
-        base = [0.0] * self.model.num_states
-        particle_dist = elem_distribution(self.tree.root.B)
-        for state, prob in particle_dist.items():
-            base[self.model.states.index(state)] = round(prob, 6)
-        return base
+        """
+        :return: the root's belief as a SparseBelief, the normalised (weighted) histogram of its particles
+        """
+        return SparseBelief.from_particles(self.tree.root.B.array, self.model.num_states, weights=self.root_weights)
 
-    def rollout(self, state, h, depth, max_depth, budget):
+    def root_particles(self):
+        """
+        :return: the particles the search starts from. Weighted root particles are resampled first,
+        so that states are drawn according to the belief.
         """
-        Perform randomized recursive rollout search starting from 'h' util the max depth has been achived
+        particles = self.tree.root.B.array
+        if self.root_weights is None:
+            return particles
+        return particles[systematic_resample(self.root_weights, len(particles))]
+
+    def rollout(self, state, depth, max_depth, budget):
+        """
+        Perform randomized rollout search starting from 'state' util the max depth has been achived
         :param state: starting state's index
-        :param h: history sequence
         :param depth: current planning horizon
         :param max_depth: max planning horizon
-        :return:
+        :return: discounted return of the rollout
         """
-        if depth > max_depth or budget <= 0:
-            return 0
+        R, discount = 0.0, 1.0
+        while depth <= max_depth and budget > 0:
+            ai = rand_choice(self.model.get_legal_action_indices(state))
+            state, oj, r, cost = self.model.simulate_action_index(state, ai)
 
-        ai = rand_choice(self.model.get_legal_actions(state))
-        sj, oj, r, cost = self.model.simulate_action(state, ai)
+            R += discount * r
+            discount *= self.model.discount
+            budget -= cost
+            depth += 1
+        return R
 
-        return r + self.model.discount * self.rollout(sj, h + [ai, oj], depth + 1, max_depth, budget-cost)
-        
-    def simulate(self, state, max_depth, depth=0, h=[], parent=None, budget=None):
+    def simulate(self, state, max_depth, depth=0, parent=None, observation=None, budget=None):
         """
-        Perform MCTS simulation on a POMCP belief search tree
+        Perform MCTS simulation on a POMCP belief search tree.
+        The current belief node is reached from its parent action node and the observation, so no history
+        sequence is built or walked during the search; node.h reconstructs it on demand.
+
         :param state: starting state's index
+        :param parent: action node leading to the current belief node, None at the root
+        :param observation: observation index leading to the current belief node
         :return:
         """
         # Stop recursion once we are deep enough in our built tree
         if depth > max_depth:
             return 0
 
-        obs_h = None if not h else h[-1]
-        node_h = self.tree.find_or_create(h, name=obs_h or 'root', parent=parent,
-                                          budget=budget, observation=obs_h)
+        if parent is None:
+            node_h = self.tree.root
+        else:
+            node_h = parent.get_child(observation) or \
+                self.tree.add(parent=parent, observation=observation, budget=budget)
 
         # ===== ROLLOUT =====
         # Initialize child nodes and return an approximate reward for this
         # history by rolling out until max depth
-        if not node_h.children:
+        if not self.tree.num_children[node_h.id]:
             # always reach this line when node_h was just now created
-            for ai in self.model.get_legal_actions(state):
-                cost = self.model.cost_function(ai)
-                # only adds affordable actions
-                if budget - cost >= 0:
-                    self.tree.add(h + [ai], name=ai, parent=node_h, action=ai, cost=cost)
+            costs = self.model.action_costs
+            # only adds affordable actions
+            actions = [ai for ai in self.model.get_legal_action_indices(state) if budget - costs[ai] >= 0]
+            self.tree.expand(node_h, actions, [costs[ai] for ai in actions])
 
-            return self.rollout(state, h, depth, max_depth, budget)
+            return self.rollout(state, depth, max_depth, budget)
 
         # ===== SELECTION =====
         # Find the action that maximises the utility value
-        np.random.shuffle(node_h.children)
-        node_ha = sorted(node_h.children, key=self.utility_fn, reverse=True)[0]
+        node_ha = self.tree.node(self.utility_fn(self.tree, node_h.id))
 
         # ===== SIMULATION =====
         # Perform monte-carlo simulation of the state under the action
-        sj, oj, reward, cost = self.model.simulate_action(state, node_ha.action)
-        R = reward + self.model.discount * self.simulate(sj, max_depth, depth + 1, h=h + [node_ha.action, oj],
-                                                    parent=node_ha, budget=budget-cost)
+        sj, oj, reward, cost = self.model.simulate_action_index(state, node_ha.action)
+        R = reward + self.model.discount * self.simulate(sj, max_depth, depth + 1, parent=node_ha,
+                                                         observation=oj, budget=budget-cost)
         # ===== BACK-PROPAGATION =====
-        # Update the belief node for h
-        node_h.B += [state]
+        # Update the belief node for h, the root's particles are where the states come from in the first place
+        if parent is not None:
+            node_h.B.add(state)
         node_h.N += 1
 
         # Update the action node for this action
@@ -137,16 +210,103 @@ class POMCP(Solver):
 
         return R
 
-    def solve(self, T):
+    def search(self, T):
         """
-        Solves for up to T steps
+        Runs simulations from the current root for simulation_time seconds
+        :return: number of simulations
         """
+        if self.kernel_model is not None:
+            return self.search_compiled(T)
+
+        particles = self.root_particles()
         begin = time.time()
         n = 0
         while time.time() - begin < self.simulation_time:
             n += 1
-            state = self.tree.root.sample_state()
-            self.simulate(state, max_depth=T, h=self.tree.root.h, budget=self.tree.root.budget)
+            state = particles.item(random.randrange(len(particles)))
+            self.simulate(state, max_depth=T, budget=self.tree.root.budget)
+        return n
+
+    def search_compiled(self, T):
+        """
+        Same as search, but the simulations run in batches inside pomcp_kernel.run_simulations.
+        The batch size doubles as long as a batch takes less than 1/100 of simulation_time.
+        :return: number of simulations
+        """
+        tree, n, batch = self.tree, 0, 16
+        particles = self.kernel_particles()
+        begin = time.time()
+        while time.time() - begin < self.simulation_time:
+            batch_begin = time.time()
+            root = tree.root
+            tree.reserve(batch * (1 + self.model.num_actions))
+            start = tree.counter
+            out_nodes, out_states = np.empty(batch, dtype=np.int64), np.empty(batch, dtype=np.int64)
+
+            end, n_out = pomcp_kernel.run_simulations(
+                batch, tree.root_id, particles, root.budget, T, *self.utility_args, *self.kernel_model,
+                *[getattr(tree, field) for field in BeliefTree.FIELDS], start, out_nodes, out_states)
+            tree.register(start, end)
+
+            # hand the particles of the root's grandchildren over to their particle sets
+            order = np.argsort(out_nodes[:n_out], kind='stable')
+            nodes, states = out_nodes[order], out_states[order]
+            node_ids, offsets = np.unique(nodes, return_index=True)
+            for nid, node_states in zip(node_ids, np.split(states, offsets[1:])):
+                tree.node(nid).add_particle(node_states)
+
+            n += batch
+            if time.time() - batch_begin < self.simulation_time / 100:
+                batch *= 2
+        return n
+
+    def kernel_particles(self):
+        """
+        :return: the root particles as a writable int64 copy, so that run_simulations is only ever called
+        with one kind of array and compiled once
+        """
+        return np.array(self.root_particles(), dtype=np.int64)
+
+    def compile_kernel(self, T):
+        """
+        Runs an empty batch through pomcp_kernel.run_simulations, so that it is compiled (or loaded from
+        numba's cache) before the first search rather than during its simulation_time
+        """
+        tree, nothing = self.tree, np.empty(0, dtype=np.int64)
+        pomcp_kernel.run_simulations(
+            0, tree.root_id, self.kernel_particles(), tree.root.budget, T, *self.utility_args, *self.kernel_model,
+            *[getattr(tree, field) for field in BeliefTree.FIELDS], tree.counter, nothing, nothing)
+
+    def merge_root_stats(self, results):
+        """
+        Merges the root action statistics found by other workers into this tree's root
+        :param results: [(number of simulations, [(action, N, V), ...]), ...] from each worker
+        :return: total number of simulations run by the workers
+        """
+        root = self.tree.root
+        for n, action_stats in results:
+            for action, N, V in action_stats:
+                node = root.get_child(action)
+                if node is None or N == 0:
+                    continue
+                node.V = (node.V * node.N + V * N) / (node.N + N)
+                node.N += N
+                root.N += N
+        return sum(n for n, _ in results)
+
+    def solve(self, T):
+        """
+        Solves for up to T steps
+        """
+        if self.pool is None:
+            n = self.search(T)
+        else:
+            root = self.tree.root
+            seeds = [seed.generate_state(1)[0] for seed in self.seed_sequence.spawn(self.workers - 1)]
+            particles = self.root_particles()
+            jobs = self.pool.starmap_async(search_root, [(particles, root.budget, T, seed) for seed in seeds])
+            n = self.search(T)
+            n += self.merge_root_stats(jobs.get())
         log.info('# Simulation = {}'.format(n))
 
     def get_action(self, belief):
@@ -156,7 +316,7 @@ class POMCP(Solver):
         """
         root = self.tree.root
         action_vals = [(action.V, action.action) for action in root.children]
-        return max(action_vals)[1]
+        return self.model.actions[max(action_vals)[1]]
 
     def update_belief(self, belief, action, obs):
         """
@@ -164,15 +324,59 @@ class POMCP(Solver):
         extending the history, updating particle sets, etc
         """
         m, root = self.model, self.tree.root
+        a, o = m.action_idx[action], m.obs_idx[obs]
+        action_node = root.get_child(a)
+
+        if self.particle_filter == 'weighted':
+            # the weighted filter computes the new particles itself, the search tree below is kept if there is one
+            new_root = action_node.get_child(o) or \
+                self.tree.add(parent=action_node, observation=o, budget=root.budget - action_node.cost)
+            self.weighted_update(root, new_root, a, o)
+        else:
+            new_root = self.rejection_update(root, action_node, a, o)
+
+        #####################
+        # Advance and Prune #
+        #####################
+        self.tree.advance(new_root)
+        new_root = self.tree.root   # advancing may compact the tree and renumber its nodes
+        new_belief = self.compute_belief()
+
+        ###########################
+        # Particle Reinvigoration #
+        ###########################
+        deprived = new_belief.support < self.model.num_states
+        if self.reinvigoration == 'always' or (self.reinvigoration == 'deprivation' and deprived):
+            # perform particle re-invigoration when particle deprivation happens
+            mutations = self.model.gen_particles(n=int(self.max_particles * self.reinvigorated_particles_ratio))
+            for particle in mutations:
+                i = randint(0, len(new_root.B))
+                new_root.B[i] = particle
+                if self.root_weights is not None:
+                    self.root_weights[i] = 1.0 / len(self.root_weights)
+            if self.root_weights is not None:
+                self.root_weights /= self.root_weights.sum()
+
+            # re-compute the current belief distribution after reinvigoration
+            new_belief =  self.compute_belief()
+            log.info(('*** {} random particles are added ***'.format(len(mutations))))
+        return new_belief
+
+    def rejection_update(self, root, action_node, a, o):
+        """
+        Finds the new root and fills its particle set by rejection sampling, i.e. by simulating root particles
+        until enough of them produce the real observation
+        :return: the new root
+        """
+        m = self.model
 
         #####################
         # Find the new root #
         #####################
-        new_root = root.get_child(action).get_child(obs)
+        new_root = action_node.get_child(o)
         if new_root is None:
-            log.warning("Warning: {} is not in the search tree".format(root.h + [action, obs]))
+            log.warning("Warning: {} is not in the search tree".format(self.tree.history_names(root.h + [a, o])))
             # The step result randomly produced a different observation
-            action_node = root.get_child(action)
             if action_node.children:
                 # grab any of the beliefs extending from the belief node's action node (i.e, the nearest belief node)
                 log.info('grabing a bearest belief node...')
@@ -181,47 +385,80 @@ class POMCP(Solver):
                 # or create the new belief node and rollout from there
                 log.info('creating a new belief node')
                 particles = self.model.gen_particles(n=self.max_particles)
-                new_root = self.tree.add(h=action_node.h + [obs], name=obs, parent=action_node, observation=obs,
-                                         particle=particles, budget=root.budget - action_node.cost)
+                new_root = self.tree.add(parent=action_node, observation=o, particle=particles,
+                                         budget=root.budget - action_node.cost)
         
         ##################
         # Fill Particles #
         ##################
         particle_slots = self.max_particles - len(new_root.B)
         if particle_slots > 0:
-            # fill particles by Monte-Carlo using reject sampling
+            # fill particles by Monte-Carlo using reject sampling, simulating a whole batch of root particles at once
+            root_states = self.root_particles()
             particles = []
             while len(particles) < particle_slots:
-                si = root.sample_state()
-                sj, oj, r, cost = self.model.simulate_action(si, action)
+                si = root_states[np.random.randint(len(root_states), size=particle_slots)]
+                sj, oj, _, _ = m.simulate_actions(si, a)
+                particles.extend(sj[oj == o].tolist())
+            new_root.B.extend(particles[:particle_slots])
+        return new_root
 
-                if oj == obs:
-                    particles.append(sj)
-            new_root.B += particles
+    def weighted_update(self, root, new_root, a, o):
+        """
+        Importance-weighted particle filter: every root particle is moved through T(a, s, .) and weighted by
+        the likelihood Z(a, s', o) of the real observation. The particles are resampled (systematic resampling)
+        once the effective sample size falls below ess_threshold, otherwise the weights are carried over.
+        Runs in a fixed number of vectorised steps whatever the probability of the observation.
+        """
+        m = self.model
+        particles = root.B.array
+        weights = np.ones(len(particles)) if self.root_weights is None else self.root_weights
 
-        #####################
-        # Advance and Prune #
-        #####################
-        self.tree.prune(root, exclude=new_root)
-        self.tree.root = new_root
-        new_belief = self.compute_belief()
+        next_states = m.transition_sampler.draw_many(a * m.num_states + particles)
+        weights = weights * m.dynamics.observation_likelihood(a, o)[next_states]
 
-        ###########################
-        # Particle Reinvigoration #
-        ###########################
-        if any([prob == 0.0 for prob in new_belief]):
-            # perform particle re-invigoration when particle deprivation happens
-            mutations = self.model.gen_particles(n=int(self.max_particles * self.reinvigorated_particles_ratio))
-            for particle in mutations:
-                new_root.B[randint(0, len(new_root.B))] = particle
+        total = weights.sum()
+        if total <= 0.0:
+            # none of the particles explains the observation, start over from a uniform belief
+            log.warning('Warning: no particle is consistent with observation {}'.format(m.observations[o]))
+            next_states, weights = np.asarray(m.gen_particles(n=self.max_particles)), None
+        else:
+            weights /= total
+            ess = 1.0 / np.square(weights).sum()
+            if ess < self.ess_threshold * len(weights):
+                next_states, weights = next_states[systematic_resample(weights, len(weights))], None
 
-            # re-compute the current belief distribution after reinvigoration
-            new_belief =  self.compute_belief()
-            log.info(('*** {} random particles are added ***'.format(len(mutations))))
-        return new_belief
+        new_root.B = ParticleSet(self.tree.max_particles, next_states)
+        self.root_weights = weights
 
     def draw(self, beliefs):
         """
         Dummy
         """
         pass
+
+
+# ===== Root-parallel workers =====
+# Each worker process holds its own POMCP instance, created once when the pool starts
+
+_worker = None
+
+
+def init_worker(model, configs):
+    global _worker
+    _worker = POMCP(model)
+    _worker.add_configs(**configs)
+
+
+def search_root(root_particles, budget, T, seed):
+    """
+    Searches an independent belief tree grown from the given root particles
+    :return: number of simulations and the (action, N, V) statistics of the root's action nodes
+    """
+    np.random.seed(seed)
+    random.seed(int(seed))
+    seed_jit(int(seed))
+
+    _worker.tree = BeliefTree(budget, root_particles, max_particles=_worker.max_particles)
+    n = _worker.search(T)
+    return n, [(action.action, action.N, action.V) for action in _worker.tree.root.children]
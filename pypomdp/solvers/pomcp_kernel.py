@@ -0,0 +1,168 @@
+"""
+Compiled POMCP search.
+
+run_simulations performs whole batches of POMCP simulations (tree descent, expansion, rollout and
+back-propagation) in native code, directly on the model's alias tables and the BeliefTree's arrays.
+It is equivalent to POMCP.simulate / POMCP.rollout, except that
+    - new nodes are always allocated at the end of the tree arrays (POMCP reserves the room beforehand)
+      and are registered in the tree's child_index afterwards,
+    - particles are only recorded for the root's grandchildren, i.e. the candidates for the next root,
+      and are handed back as (node, state) pairs.
+"""
+import numpy as np
+
+from numba import jit
+from models.model import Model
+from util.helper import ucb1_select, sa_ucb_select, mab_bv1_select
+
+UTILITY_FUNCTIONS = {'ucb1': 0, 'sa_ucb': 1, 'mab_bv1': 2}
+BELIEF, ACTION = 0, 1
+NIL = -1
+
+
+def supports(model):
+    """
+    The kernel only knows about the tabular dynamics of Model, models overriding how actions are
+    simulated or which actions are legal must be searched by the Python implementation
+    """
+    cls = type(model)
+    return isinstance(model, Model) and \
+        cls.simulate_action_index is Model.simulate_action_index and \
+        cls.get_legal_action_indices is Model.get_legal_action_indices
+
+
+def model_arrays(model):
+    """
+    :return: the arrays describing the model's dynamics, in run_simulations' argument order
+    """
+    return (model.transition_sampler.indptr, model.transition_sampler.outcomes,
+            model.transition_sampler.prob, model.transition_sampler.alias,
+            model.observation_sampler.indptr, model.observation_sampler.outcomes,
+            model.observation_sampler.prob, model.observation_sampler.alias,
+            np.ascontiguousarray(model.dynamics.R).ravel(),
+            np.asarray(model.action_costs, dtype=np.float64),
+            model.num_states, model.num_actions, float(model.discount))
+
+
+@jit(nopython=True, cache=True)
+def draw(indptr, outcomes, prob, alias, row):
+    start = indptr[row]
+    n = indptr[row + 1] - start
+    if n == 0:
+        raise ValueError('Row has no outcome to sample from')
+    k = start + int(np.random.random() * n)
+    if np.random.random() < prob[k]:
+        return outcomes[k]
+    return outcomes[alias[k]]
+
+
+@jit(nopython=True, cache=True)
+def run_simulations(n_sims, root_id, root_particles, root_budget, max_depth, utility, c, min_cost,
+                    t_indptr, t_outcomes, t_prob, t_alias, z_indptr, z_outcomes, z_prob, z_alias,
+                    rewards, costs, n_states, n_actions, discount,
+                    kind, label, parent, first_child, next_sibling, num_children,
+                    N, V, mean_reward, mean_cost, cost, budget, counter,
+                    out_nodes, out_states):
+    """
+    :param utility: one of UTILITY_FUNCTIONS
+    :param counter: first free slot at the end of the tree arrays
+    :param out_nodes, out_states: n_sims long buffers receiving the particles of the root's grandchildren
+    :return: the new counter and the number of recorded particles
+    """
+    path_h = np.empty(max_depth + 1, dtype=np.int64)
+    path_a = np.empty(max_depth + 1, dtype=np.int64)
+    path_s = np.empty(max_depth + 1, dtype=np.int64)
+    path_r = np.empty(max_depth + 1)
+    path_c = np.empty(max_depth + 1)
+    n_out = 0
+
+    for _ in range(n_sims):
+        state = root_particles[np.random.randint(len(root_particles))]
+        b = root_budget
+        h, o = root_id, NIL
+        depth, length, tail = 0, 0, 0.0
+
+        # ===== SELECTION & SIMULATION =====
+        while depth <= max_depth:
+            if length > 0:
+                # find or create the belief node reached by the last action and observation
+                a_node = path_a[length - 1]
+                h = first_child[a_node]
+                while h != NIL and label[h] != o:
+                    h = next_sibling[h]
+                if h == NIL:
+                    h = counter
+                    counter += 1
+                    kind[h], label[h], parent[h] = BELIEF, o, a_node
+                    first_child[h], num_children[h], N[h], V[h] = NIL, 0, 0, 0.0
+                    mean_reward[h], mean_cost[h], cost[h], budget[h] = 0.0, 0.0, 0.0, b
+                    next_sibling[h] = first_child[a_node]
+                    first_child[a_node] = h
+                    num_children[a_node] += 1
+
+            if num_children[h] == 0:
+                # ===== EXPANSION & ROLLOUT =====
+                start = counter
+                for a in range(n_actions):
+                    if b - costs[a] >= 0:
+                        kind[counter], label[counter], parent[counter] = ACTION, a, h
+                        first_child[counter], next_sibling[counter], num_children[counter] = NIL, counter + 1, 0
+                        N[counter], V[counter], mean_reward[counter], mean_cost[counter] = 0, 0.0, 0.0, 0.0
+                        cost[counter], budget[counter] = costs[a], np.inf
+                        counter += 1
+                if counter > start:
+                    next_sibling[counter - 1] = NIL
+                    first_child[h] = start
+                    num_children[h] = counter - start
+
+                s, rollout_depth, rollout_budget, scale = state, depth, b, 1.0
+                while rollout_depth <= max_depth and rollout_budget > 0:
+                    a = np.random.randint(n_actions)
+                    row = a * n_states + s
+                    s = draw(t_indptr, t_outcomes, t_prob, t_alias, row)
+                    draw(z_indptr, z_outcomes, z_prob, z_alias, a * n_states + s)
+                    tail += scale * rewards[row]
+                    scale *= discount
+                    rollout_budget -= costs[a]
+                    rollout_depth += 1
+                break
+
+            start, k = first_child[h], num_children[h]
+            if utility == 0:
+                best = ucb1_select(N[h], N[start:start + k], V[start:start + k], c)
+            elif utility == 1:
+                best = sa_ucb_select(N[h], budget[h], N[start:start + k], V[start:start + k],
+                                     mean_cost[start:start + k], c)
+            else:
+                best = mab_bv1_select(N[h], N[start:start + k], mean_reward[start:start + k],
+                                      mean_cost[start:start + k], min_cost, c)
+            a_node = start + best
+            a = label[a_node]
+
+            row = a * n_states + state
+            sj = draw(t_indptr, t_outcomes, t_prob, t_alias, row)
+            o = draw(z_indptr, z_outcomes, z_prob, z_alias, a * n_states + sj)
+            path_h[length], path_a[length], path_s[length] = h, a_node, state
+            path_r[length], path_c[length] = rewards[row], costs[a]
+            length += 1
+
+            state = sj
+            b -= costs[a]
+            depth += 1
+
+        # ===== BACK-PROPAGATION =====
+        R = tail
+        for i in range(length - 1, -1, -1):
+            h, a_node = path_h[i], path_a[i]
+            R = path_r[i] + discount * R
+            if i == 1:
+                out_nodes[n_out], out_states[n_out] = h, path_s[i]
+                n_out += 1
+            N[h] += 1
+
+            mean_cost[a_node] = (mean_cost[a_node] * N[a_node] + path_c[i]) / (N[a_node] + 1)
+            mean_reward[a_node] = (mean_reward[a_node] * N[a_node] + path_r[i]) / (N[a_node] + 1)
+            N[a_node] += 1
+            V[a_node] += (R - V[a_node]) / N[a_node]
+
+    return counter, n_out
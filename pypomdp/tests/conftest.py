@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# the modules import each other by their top-level names, as when running main.py from pypomdp
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from parsers import PomdpParser
+
+POMDP_FOLDER = os.path.join(ROOT, 'environments', 'pomdp')
+POMDP_FILES = sorted(os.listdir(POMDP_FOLDER))
+
+
+@pytest.fixture
+def parse():
+    """
+    :return: function parsing a shipped .POMDP file by name into a PomdpParser
+    """
+    def parse(name, sparse=False, cache_dir=None):
+        with PomdpParser(os.path.join(POMDP_FOLDER, name), sparse=sparse, cache_dir=cache_dir) as ctx:
+            return ctx
+    return parse
+
+
+@pytest.fixture(params=POMDP_FILES)
+def pomdp_file(request):
+    return request.param
+
+
+@pytest.fixture
+def pomdp_folder():
+    return POMDP_FOLDER
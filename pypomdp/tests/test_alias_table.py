@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from util.alias_table import AliasTable
+from util.csr_matrix import CSRMatrix
+
+WEIGHTS = np.array([
+    [1.0, 2.0, 3.0, 0.0, 4.0],
+    [0.0, 0.0, 5.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 0.0, 0.0],
+    [0.1, 0.1, 0.1, 0.1, 0.6],
+])
+
+
+def row_distribution(table, row, n_outcomes):
+    """
+    :return: the exact distribution a row of the table samples from: every slot is picked with probability 1/n,
+    then keeps its own outcome with probability prob and switches to its alias otherwise
+    """
+    start, end = table.indptr[row], table.indptr[row + 1]
+    dist = np.zeros(n_outcomes)
+    for k in range(start, end):
+        dist[table.outcomes[k]] += table.prob[k] / (end - start)
+        dist[table.outcomes[table.alias[k]]] += (1.0 - table.prob[k]) / (end - start)
+    return dist
+
+
+def test_rows_sample_their_normalised_weights():
+    table = AliasTable.from_csr(CSRMatrix.from_dense(WEIGHTS))
+    for row in (0, 1, 3):
+        np.testing.assert_allclose(row_distribution(table, row, WEIGHTS.shape[1]),
+                                   WEIGHTS[row] / WEIGHTS[row].sum(), atol=1e-12)
+
+
+def test_draws_follow_the_distribution():
+    np.random.seed(0)
+    table = AliasTable.from_csr(CSRMatrix.from_dense(WEIGHTS))
+    draws = table.draw_many(np.zeros(200000, dtype=np.int64))
+    frequencies = np.bincount(draws, minlength=WEIGHTS.shape[1]) / len(draws)
+    np.testing.assert_allclose(frequencies, WEIGHTS[0] / WEIGHTS[0].sum(), atol=0.005)
+    assert all(table.draw(1) == 2 for _ in range(100))
+
+
+def test_empty_rows_cannot_be_drawn_from():
+    table = AliasTable.from_csr(CSRMatrix.from_dense(WEIGHTS))
+    with pytest.raises(ValueError):
+        table.draw(2)
+    with pytest.raises(ValueError):
+        table.draw_many([0, 2])
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from util import alpha_vector
+
+
+def test_prune_drops_duplicates_and_dominated_vectors():
+    vectors = np.array([
+        [1.0, 0.0],
+        [0.0, 1.0],
+        [1.0, 0.0],     # duplicate of 0
+        [0.5, -1.0],    # dominated by 0
+        [0.6, 0.6],     # best around the middle of the simplex
+        [0.0, 1.0],     # duplicate of 1
+    ])
+    np.testing.assert_array_equal(alpha_vector.prune(vectors), [0, 1, 4])
+
+
+def test_prune_keeps_the_value_function():
+    rng = np.random.RandomState(0)
+    vectors = rng.uniform(-10, 10, (60, 4))
+    vectors = np.concatenate([vectors, vectors[:10]])
+    keep = alpha_vector.prune(vectors)
+    assert len(keep) < len(vectors)
+
+    beliefs = rng.dirichlet(np.ones(4), 1000)
+    np.testing.assert_allclose(beliefs.dot(vectors[keep].T).max(axis=1), beliefs.dot(vectors.T).max(axis=1))
+
+
+def test_lp_prune_drops_vectors_dominated_by_combinations():
+    pytest.importorskip('scipy')
+    vectors = np.array([[1.0, 0.0], [0.0, 1.0], [0.4, 0.4]])
+    np.testing.assert_array_equal(alpha_vector.prune(vectors), [0, 1, 2])
+    np.testing.assert_array_equal(alpha_vector.prune(vectors, lp=True), [0, 1])
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from models import Model
+from solvers import POMCP
+from util.belief_tree import BELIEF, ACTION, NIL
+
+
+def reachable(tree):
+    """
+    Walks the tree from the root, checking the links of every node on the way
+    :return: ids of the nodes reachable from the root
+    """
+    seen, stack = [], [tree.root_id]
+    while stack:
+        nid = stack.pop()
+        seen.append(nid)
+        children = list(tree.child_ids(nid))
+        assert tree.num_children[nid] == len(children)
+        assert len({int(tree.label[cid]) for cid in children}) == len(children)
+        for cid in children:
+            assert tree.parent[cid] == nid
+            assert tree.kind[cid] == (ACTION if tree.kind[nid] == BELIEF else BELIEF)
+            assert tree.child_index[(nid, int(tree.label[cid]))] == cid
+        if tree.kind[nid] == BELIEF and children:
+            # the action children of a belief node occupy one block of consecutive slots
+            assert sorted(children) == list(range(tree.first_child[nid], tree.first_child[nid] + len(children)))
+        stack.extend(children)
+    return seen
+
+
+@pytest.mark.parametrize('compiled', [True, False])
+def test_tree_links_stay_consistent_across_updates(parse, compiled):
+    np.random.seed(1)
+    ctx = parse('Tiger-3D.POMDP')
+    belief = ctx.generate_beliefs()
+    pomcp = POMCP(Model(ctx.copy_env()))
+    pomcp.add_configs(initial_belief=belief, simulation_time=0.05, C=10.0, compiled=compiled)
+
+    for _ in range(3):
+        pomcp.solve(3)
+        tree = pomcp.tree
+        nodes = reachable(tree)
+        assert tree.parent[tree.root_id] == NIL
+        assert len(set(nodes)) == len(nodes) == len(tree)
+        assert tree.child_index.keys() == {(int(tree.parent[cid]), int(tree.label[cid]))
+                                           for cid in nodes if cid != tree.root_id}
+
+        action = pomcp.get_action(belief)
+        _, obs, _, _ = pomcp.take_action(action)
+        belief = pomcp.update_belief(belief, action, obs)
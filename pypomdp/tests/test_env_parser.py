@@ -0,0 +1,56 @@
+import numpy as np
+
+from models.dynamics import DenseDynamics
+
+STATES = ['tiger-left', 'tiger-right']
+ACTIONS = ['listen', 'open-left', 'open-right', 'halt']
+OBSERVATIONS = ['tiger-left', 'tiger-right']
+
+
+def tiger_tables():
+    """
+    :return: the T, Z and R dictionaries of Tiger-2D.POMDP, keyed by names as the tables used to be parsed
+    """
+    T = {('listen', s, s): 1.0 for s in STATES}
+    T.update({(a, '*', '*'): 0.5 for a in ('open-left', 'open-right')})
+    Z = {('listen', s, o): 0.85 if s == o else 0.15 for s in STATES for o in OBSERVATIONS}
+    Z.update({(a, '*', '*'): 0.5 for a in ('open-left', 'open-right')})
+    R = {
+        ('listen', 'tiger-left', '*', '*'): -1,
+        ('listen', 'tiger-right', '*', '*'): -1,
+        ('open-left', 'tiger-left', '*', '*'): -100,
+        ('open-left', 'tiger-right', '*', '*'): 10,
+        ('open-right', 'tiger-left', '*', '*'): 10,
+        ('open-right', 'tiger-right', '*', '*'): -100,
+    }
+    return T, Z, R
+
+
+def test_parser_matches_name_keyed_tables(parse):
+    ctx = parse('Tiger-2D.POMDP')
+    expected = DenseDynamics.from_tables(STATES, ACTIONS, OBSERVATIONS, *tiger_tables())
+
+    assert (ctx.states, ctx.actions, ctx.observations) == (STATES, ACTIONS, OBSERVATIONS)
+    assert ctx.discount == 0.75
+    assert ctx.costs == [-1, -1, -1, 0]
+    np.testing.assert_array_equal(ctx.dynamics.T, expected.T)
+    np.testing.assert_array_equal(ctx.dynamics.Z, expected.Z)
+    np.testing.assert_array_equal(ctx.dynamics.R, expected.R)
+    assert ctx.dynamics.R_full is None and expected.R_full is None
+
+
+def test_dense_and_sparse_parses_agree(parse, pomdp_file):
+    dense, sparse = parse(pomdp_file).dynamics, parse(pomdp_file, sparse=True).dynamics
+
+    np.testing.assert_array_equal(dense.R, sparse.R)
+    for a in range(dense.T.shape[0]):
+        for expected, actual in zip(dense.dense_tables(a), sparse.dense_tables(a)):
+            np.testing.assert_array_equal(expected, actual)
+
+
+def test_tables_are_distributions(parse, pomdp_file):
+    dynamics = parse(pomdp_file).dynamics
+    # rows are either distributions or empty, for actions undefined in some states
+    for table in (dynamics.T, dynamics.Z):
+        sums = table.sum(axis=2)
+        assert np.all(np.isclose(sums, 1.0) | (sums == 0.0))
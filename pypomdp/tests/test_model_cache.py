@@ -0,0 +1,46 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from parsers import PomdpParser, model_cache
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_cache_round_trip(parse, pomdp_folder, pomdp_file, sparse, tmp_path):
+    parsed = parse(pomdp_file, sparse=sparse, cache_dir=str(tmp_path))
+    cached = model_cache.cache_file(str(tmp_path), os.path.join(pomdp_folder, pomdp_file), sparse)
+    assert os.path.exists(cached)
+
+    loaded = parse(pomdp_file, sparse=sparse, cache_dir=str(tmp_path))
+    assert type(loaded.dynamics) is type(parsed.dynamics)
+    for attr in model_cache.NAME_LISTS + model_cache.SCALARS + ('start', 'costs'):
+        assert getattr(loaded, attr) == getattr(parsed, attr), attr
+
+    expected, actual = parsed.dynamics.to_arrays(), loaded.dynamics.to_arrays()
+    assert expected.keys() == actual.keys()
+    for name in expected:
+        np.testing.assert_array_equal(expected[name], actual[name], err_msg=name)
+
+
+def test_saving_evicts_entries_of_previous_contents(pomdp_folder, tmp_path):
+    source = tmp_path / 'Tiger-2D.POMDP'
+    shutil.copy(os.path.join(pomdp_folder, 'Tiger-2D.POMDP'), str(source))
+    shutil.copy(os.path.join(pomdp_folder, 'Tiger-3D.POMDP'), str(tmp_path))
+    cache_dir = str(tmp_path / 'cache')
+
+    def cache(config_file, sparse=False):
+        with PomdpParser(str(config_file), sparse=sparse, cache_dir=cache_dir):
+            pass
+        return os.path.basename(model_cache.cache_file(cache_dir, str(config_file), sparse))
+
+    old_dense, old_sparse = cache(source), cache(source, sparse=True)
+    other = cache(tmp_path / 'Tiger-3D.POMDP')
+    assert sorted(os.listdir(cache_dir)) == sorted([old_dense, old_sparse, other])
+
+    with open(str(source), 'a') as f:
+        f.write('\n# edited\n')
+    new_dense = cache(source)
+    assert new_dense != old_dense
+    assert sorted(os.listdir(cache_dir)) == sorted([new_dense, other])
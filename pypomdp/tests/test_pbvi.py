@@ -0,0 +1,57 @@
+import numpy as np
+
+from models import Model
+from solvers import PBVI
+
+
+def solved(ctx, T=30):
+    np.random.seed(0)
+    pbvi = PBVI(Model(ctx.copy_env()))
+    pbvi.add_configs(ctx.generate_beliefs(), epsilon=1e-3)
+    pbvi.solve(T)
+    return pbvi
+
+
+def fresh(ctx, sparse=False):
+    pbvi = PBVI(Model(ctx.copy_env(), sparse=sparse))
+    pbvi.add_configs(ctx.generate_beliefs())
+    return pbvi
+
+
+def test_fingerprint_ignores_the_storage_layout(parse, pomdp_file):
+    dense = Model(parse(pomdp_file).copy_env())
+    sparse = Model(parse(pomdp_file, sparse=True).copy_env(), sparse=True)
+    assert dense.fingerprint() == sparse.fingerprint()
+
+
+def test_fingerprint_tells_models_apart(parse):
+    tiger_2d, tiger_3d = Model(parse('Tiger-2D.POMDP').copy_env()), Model(parse('Tiger-3D.POMDP').copy_env())
+    assert tiger_2d.fingerprint() != tiger_3d.fingerprint()
+
+    env = parse('Tiger-2D.POMDP').copy_env()
+    env['discount'] = 0.9
+    assert Model(env).fingerprint() != tiger_2d.fingerprint()
+
+
+def test_policy_round_trip(parse, tmp_path):
+    ctx = parse('Tiger-3D.POMDP')
+    pbvi = solved(ctx)
+    pbvi.save_policy(str(tmp_path))
+
+    for sparse in (False, True):
+        loaded = fresh(parse('Tiger-3D.POMDP', sparse=sparse), sparse=sparse)
+        assert loaded.load_policy(str(tmp_path))
+        assert loaded.solved
+        np.testing.assert_array_equal(loaded.alphas, pbvi.alphas)
+        np.testing.assert_array_equal(loaded.alpha_actions, pbvi.alpha_actions)
+
+        beliefs = np.random.dirichlet(np.ones(pbvi.model.num_states), 200)
+        assert loaded.get_actions(beliefs) == pbvi.get_actions(beliefs)
+
+
+def test_policy_of_another_model_is_ignored(parse, tmp_path):
+    solved(parse('Tiger-3D.POMDP')).save_policy(str(tmp_path))
+    other = fresh(parse('Tiger-2D.POMDP'))
+    assert not other.load_policy(str(tmp_path))
+    assert not other.solved
+    assert not fresh(parse('Tiger-2D.POMDP')).load_policy(str(tmp_path / 'missing'))
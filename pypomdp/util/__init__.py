@@ -1,6 +1,9 @@
 
 from .helper import *
 from .alpha_vector import AlphaVector
+from .csr_matrix import CSRMatrix
+from .particle_set import ParticleSet
+from .sparse_belief import SparseBelief
 from .belief_tree import Node, BeliefTree, BeliefNode, ActionNode
 from .runner_params import RunnerParams
 
@@ -0,0 +1,120 @@
+import random
+import numpy as np
+
+from numba import jit
+
+
+@jit(nopython=True, cache=True)
+def build_alias(indptr, weights, prob, alias):
+    """
+    Vose's alias method, run independently on every row of a CSR layout.
+    alias holds absolute positions into the row's entries.
+    """
+    n_max = 0
+    for r in range(len(indptr) - 1):
+        n_max = max(n_max, indptr[r + 1] - indptr[r])
+    small = np.empty(n_max, dtype=np.int64)
+    large = np.empty(n_max, dtype=np.int64)
+
+    for r in range(len(indptr) - 1):
+        start, end = indptr[r], indptr[r + 1]
+        n = end - start
+        total = weights[start:end].sum()
+        if n == 0 or total <= 0.0:
+            continue
+
+        n_small, n_large = 0, 0
+        for k in range(start, end):
+            prob[k] = weights[k] * n / total
+            alias[k] = k
+            if prob[k] < 1.0:
+                small[n_small] = k
+                n_small += 1
+            else:
+                large[n_large] = k
+                n_large += 1
+
+        while n_small > 0 and n_large > 0:
+            n_small -= 1
+            s, l = small[n_small], large[n_large - 1]
+            alias[s] = l
+            prob[l] = prob[l] + prob[s] - 1.0
+            if prob[l] < 1.0:
+                n_large -= 1
+                small[n_small] = l
+                n_small += 1
+
+        # whatever is left over is 1.0 up to rounding errors
+        for i in range(n_large):
+            prob[large[i]] = 1.0
+        for i in range(n_small):
+            prob[small[i]] = 1.0
+
+
+class AliasTable(object):
+    """
+    Alias tables for a whole family of discrete distributions, one per row of a CSR matrix whose
+    non-zero entries are the (outcome, weight) pairs. Drawing from any row is O(1) and allocation free.
+    """
+    FIELDS = ('indptr', 'outcomes', 'prob', 'alias')
+
+    def __init__(self, indptr, outcomes, prob, alias):
+        self.indptr = indptr
+        self.outcomes = outcomes
+        self.prob = prob
+        self.alias = alias
+
+        # memoryviews index into the numpy buffers without creating numpy scalars
+        self._indptr = memoryview(indptr)
+        self._outcomes = memoryview(outcomes)
+        self._prob = memoryview(prob)
+        self._alias = memoryview(alias)
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @staticmethod
+    def from_csr(m):
+        """
+        :param m: CSRMatrix holding one (not necessarily normalised) distribution per row
+        """
+        indptr = np.ascontiguousarray(m.indptr, dtype=np.int64)
+        prob = np.zeros(m.nnz)
+        alias = np.zeros(m.nnz, dtype=np.int64)
+        build_alias(indptr, np.ascontiguousarray(m.data, dtype=np.float64), prob, alias)
+        return AliasTable(indptr, np.ascontiguousarray(m.indices, dtype=np.int64), prob, alias)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.outcomes.nbytes + self.prob.nbytes + self.alias.nbytes
+
+    def draw(self, row):
+        """
+        :return: an outcome sampled from the distribution of the given row
+        """
+        start = self._indptr[row]
+        n = self._indptr[row + 1] - start
+        if n == 0:
+            raise ValueError('Row {} has no outcome to sample from'.format(row))
+
+        k = start + int(random.random() * n)
+        if random.random() < self._prob[k]:
+            return self._outcomes[k]
+        return self._outcomes[self._alias[k]]
+
+    def draw_many(self, rows):
+        """
+        Vectorised draw, one outcome for every row index in rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        start = self.indptr[rows]
+        n = self.indptr[rows + 1] - start
+        if rows.size and not n.all():
+            raise ValueError('Rows {} have no outcome to sample from'.format(np.unique(rows[n == 0])))
+
+        k = start + (np.random.random(rows.shape) * n).astype(np.int64)
+        accept = np.random.random(rows.shape) < self.prob[k]
+        return self.outcomes[np.where(accept, k, self.alias[k])]
@@ -1,3 +1,10 @@
+import numpy as np
+
+try:
+    from scipy.optimize import linprog
+except ImportError:    # only needed for LP pruning
+    linprog = None
+
 
 class AlphaVector(object):
     """
@@ -10,3 +17,57 @@ class AlphaVector(object):
 
     def copy(self):
         return AlphaVector(self.action, self.v)
+
+
+def pointwise_dominated(vectors):
+    """
+    :param vectors: |Gamma| x |S| matrix without duplicate rows
+    :return: mask of the vectors some other vector is at least as large as in every state
+    """
+    dominated = np.zeros(len(vectors), dtype=bool)
+    for i, v in enumerate(vectors):
+        others = (vectors >= v).all(axis=1)
+        others[i] = False
+        dominated[i] = others.any()
+    return dominated
+
+
+def lp_dominated(vectors, epsilon=1e-9):
+    """
+    A vector is useless when there is no belief at which it beats all the others, i.e. when
+        max d  s.t.  b . (v - w) >= d for every other w, sum(b) = 1, b >= 0
+    is not positive. Vectors are checked one by one against the ones not yet found useless.
+    :return: mask of the useless vectors
+    """
+    if linprog is None:
+        raise ImportError('LP pruning of alpha vectors requires scipy')
+
+    n, n_states = vectors.shape
+    useless = np.zeros(n, dtype=bool)
+    for i, v in enumerate(vectors):
+        others = vectors[~useless & (np.arange(n) != i)]
+        if not len(others):
+            continue
+        # variables [b, d], minimise -d
+        res = linprog(c=np.r_[np.zeros(n_states), -1.0],
+                      A_ub=np.c_[others - v, np.ones(len(others))], b_ub=np.zeros(len(others)),
+                      A_eq=np.r_[np.ones(n_states), 0.0][None, :], b_eq=[1.0],
+                      bounds=[(0, None)] * n_states + [(None, None)], method='highs')
+        useless[i] = res.status == 0 and -res.fun <= epsilon
+    return useless
+
+
+def prune(vectors, lp=False):
+    """
+    Removes duplicate and pointwise dominated vectors, and with lp also the vectors dominated by a combination of
+    the others
+    :param vectors: |Gamma| x |S| matrix
+    :return: sorted indices of the vectors kept
+    """
+    vectors = np.asarray(vectors)
+    _, keep = np.unique(vectors, axis=0, return_index=True)
+    keep = np.sort(keep)
+    keep = keep[~pointwise_dominated(vectors[keep])]
+    if lp:
+        keep = keep[~lp_dominated(vectors[keep])]
+    return keep
@@ -1,56 +1,102 @@
+from util.helper import round
+from util.particle_set import ParticleSet
+import numpy as np
+
+BELIEF, ACTION = 0, 1
+NIL = -1
 
-from util.helper import rand_choice, round
-from abc import abstractmethod
 
 class Node(object):
-    def __init__(self, nid, name, h, parent=None, V=0, N=0):
-        self.h = h
-        self.V = V
-        self.N = N
+    """
+    Lightweight view of a node stored in a BeliefTree. All node data lives in the tree's arrays,
+    so views can be created and dropped freely; two views of the same node compare equal.
+    """
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, nid):
+        self.tree = tree
         self.id = nid
-        self.name = name
-        self.parent = parent
-        self.children = []
 
-    @abstractmethod
-    def add_child(self, node):
-        """
-         To be implemented.
-        """
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.tree is other.tree and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    @property
+    def N(self):
+        return self.tree.N[self.id]
+
+    @N.setter
+    def N(self, value):
+        self.tree.N[self.id] = value
+
+    @property
+    def V(self):
+        return self.tree.V[self.id]
+
+    @V.setter
+    def V(self, value):
+        self.tree.V[self.id] = value
+
+    @property
+    def parent(self):
+        pid = self.tree.parent[self.id]
+        return None if pid == NIL else self.tree.node(pid)
+
+    @property
+    def children(self):
+        return [self.tree.node(cid) for cid in self.tree.child_ids(self.id)]
+
+    @property
+    def h(self):
+        return self.tree.history_of(self.id)
+
+    def get_child(self, label):
+        cid = self.tree.child_index.get((self.id, label))
+        return None if cid is None else self.tree.node(cid)
 
-    @abstractmethod
-    def get_child(self, *args):
-        """
-         To be implemented.
-        """
 
 class BeliefNode(Node):
     """
     Represents a node that holds the belief distribution given its history sequence in a belief tree.
     It also holds the received observation after which the belief is updated accordingly
     """
-    def __init__(self, nid, name, h, obs_index, parent=None, V=0, N=0, budget=float('inf')):
-        Node.__init__(self, nid, name, h, parent, V, N)
-        self.observation = obs_index
-        self.budget = budget
-        self.B = []
-        self.action_map = {}
+    __slots__ = ()
+
+    @property
+    def observation(self):
+        return self.tree.label[self.id]
+
+    @property
+    def name(self):
+        if self.id == self.tree.root_id:
+            return 'root'
+        return self.tree.observation_name(self.observation)
 
-    def add_child(self, node):
-        self.children.append(node)
-        self.action_map[node.action] = node
+    @property
+    def budget(self):
+        return self.tree.budget[self.id]
 
-    def get_child(self, action):
-        return self.action_map.get(action, None)
+    @property
+    def B(self):
+        B = self.tree.particles.get(self.id)
+        if B is None:
+            B = self.tree.particles[self.id] = ParticleSet(self.tree.max_particles)
+        return B
+
+    @B.setter
+    def B(self, particles):
+        self.tree.particles[self.id] = particles
 
     def sample_state(self):
-        return rand_choice(self.B)
+        return self.B.sample()
 
     def add_particle(self, particle):
-        if type(particle) is list:
+        if np.ndim(particle):
             self.B.extend(particle)
         else:
-            self.B.append(particle)
+            self.B.add(particle)
 
     def __repr__(self):
         return 'Bid = {}, N = {}'.format(self.id, self.N)
@@ -60,24 +106,32 @@ class ActionNode(Node):
     """
     represents the node associated with an POMDP action
     """
-    def __init__(self, nid, name, h, action_index, cost, parent=None, V=0, N=0):
-        Node.__init__(self, nid, name, h, parent, V, N)
-        self.mean_reward = 0.0
-        self.mean_cost = 0.0
-        self.cost = cost
-        self.action = action_index
-        self.obs_map = {}
+    __slots__ = ()
 
-    def update_stats(self, cost, reward):
-        self.mean_cost = (self.mean_cost * self.N + cost) / (self.N + 1)
-        self.mean_reward = (self.mean_reward * self.N + reward) / (self.N + 1)
+    @property
+    def action(self):
+        return self.tree.label[self.id]
+
+    @property
+    def name(self):
+        return self.tree.action_name(self.action)
+
+    @property
+    def cost(self):
+        return self.tree.cost[self.id]
 
-    def add_child(self, node):
-        self.children.append(node)
-        self.obs_map[node.observation] = node
+    @property
+    def mean_reward(self):
+        return self.tree.mean_reward[self.id]
 
-    def get_child(self, observation):
-        return self.obs_map.get(observation, None)
+    @property
+    def mean_cost(self):
+        return self.tree.mean_cost[self.id]
+
+    def update_stats(self, cost, reward):
+        t, i = self.tree, self.id
+        t.mean_cost[i] = (t.mean_cost[i] * t.N[i] + cost) / (t.N[i] + 1)
+        t.mean_reward[i] = (t.mean_reward[i] * t.N[i] + reward) / (t.N[i] + 1)
 
     def __repr__(self):
         return 'Aid = {}, N = {}, V = {}'.format(self.id, self.N, round(self.V, 6))
@@ -86,14 +140,138 @@ class ActionNode(Node):
 class BeliefTree:
     """
     The belief tree decipted in Silver's POMCP paper.
+
+    Nodes are stored as a struct of arrays (one growable numpy array per node attribute) rather than as
+    Python objects. The action children of a belief node are created together by expand and occupy one block
+    of consecutive slots [first_child, first_child + num_children), so their statistics can be read as array
+    slices. The observation children of an action node form a singly linked list through
+    first_child/next_sibling. child_index maps (node id, action/observation label) => child id.
+    Slots of pruned nodes and action blocks are recycled.
+    Actions and observations are identified by their integer indices. Every belief node keeps at most
+    max_particles particles (see ParticleSet).
     """
-    def __init__(self, total_budget, root_particles):
+    FIELDS = {
+        'kind': np.int8,
+        'label': np.int64,
+        'parent': np.int64,
+        'first_child': np.int64,
+        'next_sibling': np.int64,
+        'num_children': np.int64,
+        'N': np.int64,
+        'V': np.float64,
+        'mean_reward': np.float64,
+        'mean_cost': np.float64,
+        'cost': np.float64,
+        'budget': np.float64,
+    }
+
+    def __init__(self, total_budget, root_particles, action_names=None, observation_names=None,
+                 max_particles=None, capacity=1024):
         """
         :param root_particles: particles sampled from the prior belief distribution; used as initial root's particle set
+        :param action_names: optional names of the actions, only used for display
+        :param observation_names: optional names of the observations, only used for display
+        :param max_particles: capacity of each belief node's particle set, defaults to the number of root particles
+        :param capacity: number of nodes to preallocate, arrays are doubled whenever they are full
+        """
+        for field, dtype in self.FIELDS.items():
+            setattr(self, field, np.zeros(capacity, dtype=dtype))
+        self.capacity = capacity
+        self.counter = 0        # high-water mark of used slots
+        self.free_blocks = {}   # block size => start slots of pruned blocks, reused before growing
+        self.n_free = 0
+        self.child_index = {}
+        self.particles = {}
+        self.max_particles = max_particles or len(root_particles)
+
+        self.action_names = action_names
+        self.observation_names = observation_names
+        self.history = []     # the history leading to the root, the rest is recovered from parent links
+        self.root_id = NIL
+        self.root_id = self.add(particle=root_particles, budget=total_budget).id
+
+    def __len__(self):
+        return self.counter - self.n_free
+
+    @property
+    def root(self):
+        return self.node(self.root_id)
+
+    def node(self, nid):
+        return (ActionNode if self.kind[nid] == ACTION else BeliefNode)(self, nid)
+
+    def action_name(self, action):
+        return action if self.action_names is None else self.action_names[action]
+
+    def observation_name(self, observation):
+        return observation if self.observation_names is None else self.observation_names[observation]
+
+    def history_names(self, history):
         """
-        self.counter = 0
-        self.nodes = {}
-        self.root = self.add(h=[], name='root', particle=root_particles, budget=total_budget)
+        :return: the history sequence with the names of its actions and observations, which alternate
+        """
+        return [self.observation_name(label) if i % 2 else self.action_name(label) for i, label in enumerate(history)]
+
+    def child_ids(self, nid):
+        cid = self.first_child[nid]
+        while cid != NIL:
+            yield cid
+            cid = self.next_sibling[cid]
+
+    def history_of(self, nid):
+        """
+        Reconstructs the history sequence of a node by walking up to the root
+        """
+        labels = []
+        while nid != self.root_id:
+            labels.append(int(self.label[nid]))
+            nid = self.parent[nid]
+        return self.history + labels[::-1]
+
+    def __grow(self):
+        self.capacity *= 2
+        for field in self.FIELDS:
+            old = getattr(self, field)
+            new = np.zeros(self.capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, field, new)
+
+    def __alloc(self, k=1):
+        """
+        :return: first slot of a block of k consecutive free slots
+        """
+        free = self.free_blocks.get(k)
+        if free:
+            self.n_free -= k
+            return free.pop()
+        while self.counter + k > self.capacity:
+            self.__grow()
+        self.counter += k
+        return self.counter - k
+
+    def __free(self, start, k=1):
+        self.free_blocks.setdefault(k, []).append(start)
+        self.n_free += k
+
+    def __init_slots(self, block, kind, label, parent, cost=0.0, budget=float('inf')):
+        self.kind[block] = kind
+        self.label[block] = label
+        self.parent[block] = parent
+        self.first_child[block] = self.next_sibling[block] = NIL
+        self.num_children[block] = self.N[block] = 0
+        self.V[block] = self.mean_reward[block] = self.mean_cost[block] = 0.0
+        self.cost[block] = cost
+        self.budget[block] = budget
+
+    def __unlink(self, pid, nid):
+        self.num_children[pid] -= 1
+        if self.first_child[pid] == nid:
+            self.first_child[pid] = self.next_sibling[nid]
+            return
+        for cid in self.child_ids(pid):
+            if self.next_sibling[cid] == nid:
+                self.next_sibling[cid] = self.next_sibling[nid]
+                return
 
     def __pretty_print__(self, root, depth):
         if not root.children:
@@ -104,72 +282,174 @@ class BeliefTree:
             print('|  ' * depth + str(node))
             self.__pretty_print__(node, depth + 1)
 
-    def add(self, h, name, parent=None, action=None, observation=None,
-            particle=None, budget=None, cost=None):
+    def add(self, parent=None, action=None, observation=None, particle=None, budget=None, cost=None):
         """
-        Creates and adds a new belief node or action node to the belief search tree
+        Creates and adds a new belief node or action node to the belief search tree.
+        Action nodes can only be added to a belief node without children, use expand to add several.
 
-        :param h: history sequence
         :param parent: either ActionNode or BeliefNode
-        :param action: action name
-        :param observation: observation name
+        :param action: action index
+        :param observation: observation index
         :param particle: new node's particle set
         :param budget: remaining budget of a belief nodde
         :param cost: action cost of an action node
         :return:
         """
-        history = h[:]
-
-        # instantiate node
         if action is not None:
-            n = ActionNode(self.counter, name, history, parent=parent, action_index=action, cost=cost)
-        else:
-            n = BeliefNode(self.counter, name, history, parent=parent, obs_index=observation, budget=budget)
+            self.expand(parent, [action], [0.0 if cost is None else cost])
+            return self.node(self.first_child[parent.id])
 
-        if particle is not None:
-            n.add_particle(particle)
+        nid = self.__alloc()
+        self.__init_slots(nid, BELIEF, NIL if observation is None else observation,
+                          NIL if parent is None else parent.id, budget=float('inf') if budget is None else budget)
 
-        # add the node to belief tree
-        self.nodes[n.id] = n
-        self.counter += 1
+        if particle is not None:
+            self.node(nid).add_particle(particle)
 
         # register node as parent's child
         if parent is not None:
-            parent.add_child(n)
-        return n
+            self.next_sibling[nid] = self.first_child[parent.id]
+            self.first_child[parent.id] = nid
+            self.num_children[parent.id] += 1
+            self.child_index[(parent.id, observation)] = nid
+        return self.node(nid)
+
+    def expand(self, node, actions, costs):
+        """
+        Creates all action children of a belief node as one block of consecutive slots
+
+        :param node: BeliefNode without children
+        :param actions: action indices
+        :param costs: action costs
+        """
+        if self.num_children[node.id]:
+            raise ValueError('Belief node {} has already been expanded'.format(node.id))
+        k = len(actions)
+        if k == 0:
+            return
+
+        start = self.__alloc(k)
+        block = slice(start, start + k)
+        self.__init_slots(block, ACTION, actions, node.id, cost=costs)
+        self.next_sibling[start:start + k - 1] = np.arange(start + 1, start + k)
+
+        self.first_child[node.id] = start
+        self.num_children[node.id] = k
+        for i, action in enumerate(actions):
+            self.child_index[(node.id, action)] = start + i
+
+    def reserve(self, n):
+        """
+        Makes sure that n more nodes can be appended after the last used slot
+        """
+        while self.counter + n > self.capacity:
+            self.__grow()
+
+    def register(self, start, end):
+        """
+        Adopts the nodes written directly into the slots [start, end) at the end of the arrays, e.g. by the
+        compiled POMCP search, adding them to child_index
+        """
+        keys = zip(self.parent[start:end].tolist(), self.label[start:end].tolist())
+        self.child_index.update(zip(keys, range(start, end)))
+        self.counter = end
 
     def find_or_create(self, h, **kwargs):
         """
         Search for the node corrresponds to given history, otherwise create one using given params
         """
         curr = self.root
-        h_len, root_history_len = len(h), len(self.root.h)
-
-        for step in range(root_history_len, h_len):
+        for step in range(len(self.history), len(h)):
             curr = curr.get_child(h[step])
             if curr is None:
-                return self.add(h, **kwargs)
+                return self.add(**kwargs)
         return curr
 
     def prune(self, node, exclude=None):
         """
         Removes the entire subtree subscribed to 'node' with exceptions.
+        An action node's own slot belongs to its parent's block, so only its statistics and subtree are cleared.
         :param node: root of the subtree to be removed
         :param exclude: exception component
         :return:
         """
-        for child in node.children:
-            if exclude and exclude.id != child.id:
+        if self.kind[node.id] == ACTION:
+            for child in node.children:
                 self.prune(child, exclude)
+            self.__init_slots(node.id, ACTION, node.action, self.parent[node.id], cost=node.cost)
+            return
 
-        self.nodes[node.id] = None
-        del self.nodes[node.id]
+        pid = self.parent[node.id]
+        if pid != NIL and (exclude is None or exclude.id != node.id):
+            self.__unlink(pid, node.id)
+
+        stack = [node.id]
+        while stack:
+            nid = stack.pop()
+            if exclude is not None and nid == exclude.id:
+                continue
+            self.child_index.pop((self.parent[nid], self.label[nid]), None)
+
+            if self.kind[nid] == ACTION:
+                stack.extend(self.child_ids(nid))
+                continue
+
+            # a belief node frees its own slot together with the block of its action children
+            self.particles.pop(nid, None)
+            self.__free(nid)
+            k = self.num_children[nid]
+            if k:
+                start = self.first_child[nid]
+                self.__free(start, k)
+                stack.extend(range(start, start + k))
 
     def prune_siblings(self, node):
         siblings = [child for child in node.parent.children if child.id != node.id]
         for sb in siblings:
             self.prune(sb)
 
+    def advance(self, new_root):
+        """
+        Makes a descendant of the current root the new root, pruning everything else
+        """
+        self.history = new_root.h
+        self.prune(self.root, exclude=new_root)
+        self.child_index.pop((self.parent[new_root.id], self.label[new_root.id]), None)
+        self.parent[new_root.id] = NIL
+        self.root_id = new_root.id
+        if self.n_free > len(self):
+            self.compact()
+
+    def compact(self):
+        """
+        Moves the live nodes to the front of the arrays, keeping every action block contiguous, so that
+        the trailing slots can be appended to again. Node ids change; views created before are invalidated.
+        """
+        order = [self.root_id]
+        for nid in order:
+            if self.kind[nid] == BELIEF:
+                start = self.first_child[nid]
+                order.extend(range(start, start + self.num_children[nid]))
+            else:
+                order.extend(self.child_ids(nid))
+        order = np.array(order, dtype=np.int64)
+        n = len(order)
+
+        new_id = np.full(self.counter + 1, NIL, dtype=np.int64)     # new_id[NIL] stays NIL
+        new_id[order] = np.arange(n)
+        for field in self.FIELDS:
+            arr = getattr(self, field)
+            arr[:n] = arr[order]
+        for field in ('parent', 'first_child', 'next_sibling'):
+            arr = getattr(self, field)
+            arr[:n] = new_id[arr[:n]]
+
+        self.particles = {int(new_id[nid]): B for nid, B in self.particles.items()}
+        self.child_index = {}
+        self.counter, self.root_id = 1, 0
+        self.register(1, n)
+        self.free_blocks, self.n_free = {}, 0
+
     def pretty_print(self):
         """
          pretty prints tree's structure
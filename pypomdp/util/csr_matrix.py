@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class CSRMatrix(object):
+    """
+    Minimal compressed sparse row matrix built on plain numpy arrays, so that the same buffers can be handed
+    to numba kernels, saved to disk or shared between processes without any conversion.
+
+    Row i holds the column indices indices[indptr[i]:indptr[i+1]] (sorted) with the matching values in data.
+    """
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+        self._rows = None
+        self._transpose = None
+
+    @staticmethod
+    def from_triplets(rows, cols, vals, shape):
+        """
+        Builds the matrix from (row, column, value) triplets, entries are expected to be unique
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        vals = np.asarray(vals, dtype=np.float64)
+
+        order = np.lexsort((cols, rows))
+        rows, cols, vals = rows[order], cols[order], vals[order]
+        keep = vals != 0.0
+
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=shape[0]), out=indptr[1:])
+        return CSRMatrix(indptr, cols[keep], vals[keep], shape)
+
+    @staticmethod
+    def from_dense(arr):
+        rows, cols = np.nonzero(arr)
+        return CSRMatrix.from_triplets(rows, cols, arr[rows, cols], arr.shape)
+
+    @staticmethod
+    def vstack(matrices):
+        """
+        Stacks matrices with the same number of columns on top of each other
+        """
+        offsets = np.cumsum([0] + [m.nnz for m in matrices[:-1]])
+        indptr = np.concatenate([[0]] + [m.indptr[1:] + offset for m, offset in zip(matrices, offsets)])
+        return CSRMatrix(indptr.astype(np.int64),
+                         np.concatenate([m.indices for m in matrices]),
+                         np.concatenate([m.data for m in matrices]),
+                         (sum(m.shape[0] for m in matrices), matrices[0].shape[1]))
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    @property
+    def rows(self):
+        """
+        Row index of every stored entry, i.e. the COO row array
+        """
+        if self._rows is None:
+            self._rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return self._rows
+
+    @property
+    def T(self):
+        if self._transpose is None:
+            order = np.argsort(self.indices, kind='stable')
+            self._transpose = CSRMatrix.from_triplets(self.indices[order], self.rows[order], self.data[order],
+                                                      (self.shape[1], self.shape[0]))
+        return self._transpose
+
+    def row(self, i):
+        """
+        :return: (column indices, values) of the non-zero entries of row i
+        """
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def combine_rows(self, rows, weights):
+        """
+        Sparse weighted sum of rows, sum_k weights[k] * M[rows[k]], in time linear in the entries of those rows
+        :return: (column indices, values) of the non-zero entries of the sum
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, counts = self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows]
+        # positions of the rows' entries, laid out one row after the other
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        cols, inverse = np.unique(self.indices[positions], return_inverse=True)
+        values = np.bincount(inverse, weights=self.data[positions] * np.repeat(weights, counts), minlength=len(cols))
+        return cols, values
+
+    def column(self, j, rows):
+        """
+        :return: the entries M[rows, j], found through the (cached) transpose
+        """
+        cols, vals = self.T.row(j)
+        if not len(cols):
+            return np.zeros(len(rows))
+        k = np.minimum(np.searchsorted(cols, rows), len(cols) - 1)
+        return np.where(cols[k] == rows, vals[k], 0.0)
+
+    def get(self, i, j):
+        cols, vals = self.row(i)
+        k = np.searchsorted(cols, j)
+        if k < len(cols) and cols[k] == j:
+            return vals[k]
+        return 0.0
+
+    def dot(self, x):
+        """
+        Matrix product M @ x, where x is either a vector or a dense matrix with shape[1] rows
+        """
+        x = np.asarray(x)
+        if x.ndim == 1:
+            return np.bincount(self.rows, weights=self.data * x[self.indices], minlength=self.shape[0])
+
+        out = np.zeros((self.shape[0],) + x.shape[1:])
+        if self.nnz:
+            products = self.data[:, None] * x[self.indices]
+            non_empty = self.indptr[:-1] != self.indptr[1:]
+            out[non_empty] = np.add.reduceat(products, self.indptr[:-1][non_empty], axis=0)
+        return out
+
+    def rdot(self, x):
+        """
+        Matrix product x @ M, where x is either a vector or a dense matrix with shape[0] columns
+        """
+        x = np.asarray(x)
+        if x.ndim == 1:
+            return np.bincount(self.indices, weights=self.data * x[self.rows], minlength=self.shape[1])
+        return self.T.dot(x.T).T
+
+    def toarray(self):
+        arr = np.zeros(self.shape)
+        arr[self.rows, self.indices] = self.data
+        return arr
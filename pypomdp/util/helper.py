@@ -41,6 +41,24 @@ def draw_arg(probs):
     return np.random.choice(list(range(len(probs))), p=probs/probs.sum())
 
 
+def draw_args(probs, n):
+    """
+    Vectorised draw_arg, draws n indices at once
+    """
+    probs = np.asarray(probs, dtype=float)
+    return np.random.choice(len(probs), size=n, p=probs/probs.sum())
+
+
+def systematic_resample(weights, n):
+    """
+    Systematic resampling: a single uniform offset places n evenly spaced pointers on the cumulative weights
+    :return: indices of the n selected entries
+    """
+    cumulative = np.cumsum(weights)
+    positions = (np.random.random() + np.arange(n)) * (cumulative[-1] / n)
+    return np.minimum(np.searchsorted(cumulative, positions, side='right'), len(weights) - 1)
+
+
 def elem_distribution(arr):
     cnt = Counter(arr)
     _sum = sum(cnt.values())
@@ -60,22 +78,83 @@ def round(num, dec_places=2):
 
 @jit
 def rand(n=1, seed=None):
-    if seed:
+    if seed is not None:
         np.random.seed(seed)
     return np.random.rand() * n
 
 
 @jit
 def randint(low, high, seed=None):
-    if seed:
+    if seed is not None:
         np.random.seed(seed)
     return np.random.randint(low, high)
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def ucb(N_h, N_ha):
     if N_h == 0:
         return 0.0
     if N_ha == 0:
         return MAX
     return np.sqrt(np.log(N_h) / N_ha)  # Upper-Confidence-Bound
+
+
+@jit(nopython=True, cache=True)
+def seed_jit(seed):
+    """
+    Seeds numba's own random generator, which is separate from numpy's
+    """
+    np.random.seed(seed)
+
+
+@jit(nopython=True, cache=True)
+def argmax_random_tie(scores):
+    """
+    argmax that breaks ties uniformly at random, in a single pass over the scores
+    """
+    best, n_ties = 0, 1
+    for i in range(1, len(scores)):
+        if scores[i] > scores[best]:
+            best, n_ties = i, 1
+        elif scores[i] == scores[best]:
+            n_ties += 1
+            if np.random.random() * n_ties < 1.0:
+                best = i
+    return best
+
+
+@jit(nopython=True, cache=True)
+def ucb1_select(N_h, N, V, c):
+    """
+    :param N_h: visit count of the belief node
+    :param N, V: visit counts and values of its action children
+    :return: position of the child maximising V + c * ucb
+    """
+    scores = np.empty(len(N))
+    for i in range(len(N)):
+        scores[i] = V[i] + c * ucb(N_h, N[i])
+    return argmax_random_tie(scores)
+
+
+@jit(nopython=True, cache=True)
+def sa_ucb_select(N_h, budget, N, V, mean_cost, c0):
+    scores = np.empty(len(N))
+    for i in range(len(N)):
+        if mean_cost[i] == 0.0:
+            scores[i] = MAX
+        else:
+            scores[i] = V[i] + c0 * budget * ucb(N_h, N[i])
+    return argmax_random_tie(scores)
+
+
+@jit(nopython=True, cache=True)
+def mab_bv1_select(N_h, N, mean_reward, mean_cost, min_cost, c):
+    scores = np.empty(len(N))
+    for i in range(len(N)):
+        if mean_cost[i] == 0.0:
+            scores[i] = MAX
+        else:
+            ucb_value = ucb(N_h, N[i])
+            scores[i] = mean_reward[i] / mean_cost[i] + c * ((1. + 1. / min_cost) * ucb_value) / (min_cost - ucb_value)
+    return argmax_random_tie(scores)
+
@@ -0,0 +1,74 @@
+import random
+import numpy as np
+
+
+class ParticleSet(object):
+    """
+    Particle set of a belief node holding at most 'capacity' state indices.
+    Once full, new particles are admitted by reservoir sampling (Algorithm R), so the set stays a uniform
+    sample of every particle ever added while its memory stays constant.
+    """
+    __slots__ = ('particles', 'size', 'seen', 'capacity')
+
+    def __init__(self, capacity, particles=None):
+        self.capacity = capacity
+        self.particles = np.empty(min(capacity, 8), dtype=np.int64)
+        self.size = 0
+        self.seen = 0
+        if particles is not None:
+            self.extend(particles)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __getitem__(self, i):
+        return self.particles[:self.size][i]
+
+    def __setitem__(self, i, particle):
+        self.particles[:self.size][i] = particle
+
+    @property
+    def array(self):
+        """
+        :return: the stored particles as a read-only view
+        """
+        view = self.particles[:self.size]
+        view.flags.writeable = False
+        return view
+
+    def __reserve(self, n):
+        if n > len(self.particles):
+            grown = np.empty(min(self.capacity, max(n, 2 * len(self.particles))), dtype=np.int64)
+            grown[:self.size] = self.particles[:self.size]
+            self.particles = grown
+
+    def add(self, particle):
+        self.seen += 1
+        if self.size < self.capacity:
+            self.__reserve(self.size + 1)
+            self.particles[self.size] = particle
+            self.size += 1
+        else:
+            j = random.randrange(self.seen)
+            if j < self.capacity:
+                self.particles[j] = particle
+
+    def extend(self, particles):
+        particles = np.asarray(particles, dtype=np.int64)
+
+        # fill the free slots directly
+        n_free = min(self.capacity - self.size, len(particles))
+        self.__reserve(self.size + n_free)
+        self.particles[self.size:self.size + n_free] = particles[:n_free]
+        self.size += n_free
+        self.seen += n_free
+
+        # and run the reservoir over the rest
+        for particle in particles[n_free:]:
+            self.add(particle)
+
+    def sample(self):
+        return self.particles.item(random.randrange(self.size))
@@ -3,7 +3,7 @@ import os
 ROOT = os.getcwd()
 
 class RunnerParams:
-	def __init__(self, env, logfile, config, budget, max_play, snapshot, random_prior):
+	def __init__(self, env, logfile, config, budget, max_play, snapshot, random_prior, sparse, policy=None):
 		# given params
 		self.env = env
 		self.budget = budget
@@ -12,10 +12,13 @@ class RunnerParams:
 		self.random_prior = random_prior
 		self.snapshot = snapshot
 		self.logfile = logfile
+		self.sparse = sparse
+		self.policy = policy
 
 		# default params
 		self.config_folder = os.path.join(ROOT, 'configs')
-		self.env_folder = os.path.join(ROOT, 'environments', 'pomdp')
+		self.cache_folder = os.path.join(ROOT, '.cache')
+		self.env_folder = os.path.join(ROOT, 'environments', 'pomdpx' if env.endswith('.pomdpx') else 'pomdp')
 
 	@property
 	def algo_config(self):
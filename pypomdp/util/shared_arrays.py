@@ -0,0 +1,110 @@
+import os
+import numpy as np
+
+from multiprocessing import shared_memory
+
+ALIGNMENT = 64
+
+
+class SharedArrays(object):
+    """
+    Named read-only arrays living outside of the process' private memory, either packed into one
+    multiprocessing.shared_memory block or stored as .npy files mapped into memory.
+    Pickling only transfers where the arrays are and unpickling attaches to them without copying anything,
+    so every process (e.g. pool workers) reads the same physical copy.
+
+    The creator of a shared memory block owns it and must unlink it once no process needs it anymore,
+    memory-mapped files stay on disk until removed.
+    """
+    def __init__(self, arrays, shm=None, folder=None, layout=None):
+        self.arrays = arrays
+        self.shm = shm
+        self.folder = folder
+        self.layout = layout    # name => (offset, dtype, shape) inside the shared memory block
+
+    @staticmethod
+    def create(arrays):
+        """
+        Copies the arrays into a new shared memory block
+        :param arrays: dictionary of numpy arrays
+        """
+        layout, size = {}, 0
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            layout[name] = (size, arr.dtype.str, arr.shape)
+            size += -(-arr.nbytes // ALIGNMENT) * ALIGNMENT
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        shared = SharedArrays.attach(shm, layout, writeable=True)
+        for name, arr in arrays.items():
+            shared.arrays[name][...] = arr
+            shared.arrays[name].flags.writeable = False
+        return shared
+
+    @staticmethod
+    def attach(shm, layout, writeable=False):
+        """
+        :param shm: SharedMemory instance, or the name of an existing block
+        """
+        if isinstance(shm, str):
+            shm = shared_memory.SharedMemory(name=shm)
+
+        arrays = {}
+        for name, (offset, dtype, shape) in layout.items():
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            arrays[name].flags.writeable = writeable
+        return SharedArrays(arrays, shm=shm, layout=layout)
+
+    @staticmethod
+    def save(folder, arrays):
+        """
+        Writes the arrays as one .npy file each into folder and maps them back into memory
+        """
+        os.makedirs(folder, exist_ok=True)
+        for name, arr in arrays.items():
+            np.save(os.path.join(folder, name + '.npy'), np.asarray(arr), allow_pickle=False)
+        return SharedArrays.open(folder)
+
+    @staticmethod
+    def open(folder):
+        """
+        Maps every .npy file of folder into memory, read-only
+        """
+        arrays = {fname[:-len('.npy')]: np.load(os.path.join(folder, fname), mmap_mode='r', allow_pickle=False)
+                  for fname in sorted(os.listdir(folder)) if fname.endswith('.npy')}
+        return SharedArrays(arrays, folder=folder)
+
+    def __getstate__(self):
+        if self.shm is not None:
+            return {'shm': self.shm.name, 'layout': self.layout}
+        return {'folder': self.folder}
+
+    def __setstate__(self, state):
+        if 'shm' in state:
+            self.__dict__.update(SharedArrays.attach(state['shm'], state['layout']).__dict__)
+        else:
+            self.__dict__.update(SharedArrays.open(state['folder']).__dict__)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __iter__(self):
+        return iter(self.arrays)
+
+    def items(self):
+        return self.arrays.items()
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self.arrays.values())
+
+    def unlink(self):
+        """
+        Removes the shared memory block's name, the memory itself is freed once every process has let go
+        of its arrays
+        """
+        if self.shm is not None:
+            self.shm.unlink()
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class SparseBelief(object):
+    """
+    Belief distribution stored by its support only: the sorted indices of the states with a non-zero probability
+    and their probabilities. Converts to a dense vector wherever numpy expects an array (np.asarray(belief)).
+    """
+    __slots__ = ('states', 'probs', 'n_states')
+    MAX_PRINTED = 10
+
+    def __init__(self, states, probs, n_states):
+        self.states = np.asarray(states, dtype=np.int64)
+        self.probs = np.asarray(probs, dtype=float)
+        self.n_states = n_states
+
+    @staticmethod
+    def from_dense(belief):
+        belief = np.asarray(belief, dtype=float)
+        states = np.flatnonzero(belief)
+        return SparseBelief(states, belief[states], len(belief))
+
+    @staticmethod
+    def from_particles(particles, n_states, weights=None):
+        """
+        :return: the normalised (weighted) histogram of the particles, states whose particles all have a zero
+        weight are left out of the support
+        """
+        states, inverse = np.unique(particles, return_inverse=True)
+        probs = np.bincount(inverse, weights=weights, minlength=len(states))
+        kept = probs > 0
+        return SparseBelief(states[kept], probs[kept] / probs.sum(), n_states)
+
+    def __array__(self, dtype=None, copy=None):
+        dense = np.zeros(self.n_states, dtype=dtype or float)
+        dense[self.states] = self.probs
+        return dense
+
+    def toarray(self):
+        return np.asarray(self)
+
+    def tolist(self):
+        return self.toarray().tolist()
+
+    @property
+    def support(self):
+        return len(self.states)
+
+    def dot(self, vectors):
+        """
+        :param vectors: |K| x |S| matrix
+        :return: the expectation of every vector under the belief, only reading the columns of the support
+        """
+        return vectors[:, self.states].dot(self.probs)
+
+    def __str__(self):
+        order = np.argsort(-self.probs, kind='stable')[:self.MAX_PRINTED]
+        entries = ', '.join('{}: {:.6g}'.format(self.states[i], self.probs[i]) for i in order)
+        more = ', ...' if self.support > self.MAX_PRINTED else ''
+        return 'SparseBelief({} of {} states: {{{}{}}})'.format(self.support, self.n_states, entries, more)
+
+    __repr__ = __str__